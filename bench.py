@@ -0,0 +1,483 @@
+"""
+Benchmarks for the release bot.
+
+Drives the real handlers from main.py against local stand-ins:
+  * a fake OTA server serving <codename>/updates.json, with latency and error injection
+  * Redis at --redis-url, or fakeredis when no URL is given (pip install fakeredis)
+  * a fake Telegram Bot API that answers and records every call
+
+Each simulated maintainer runs /post -> notes_yes -> notes reply -> confirm_send
+in their own group chat (or all in one with --shared-chat); all maintainers
+run concurrently. Latency percentiles
+and throughput are reported per stage, followed by microbenchmarks for
+format_post and parse_notes.
+
+Usage:
+  python bench.py --maintainers 50 --rounds 5
+  python bench.py --ota-latency-ms 200 --ota-error-rate 0.05 --ota-cache-ttl 0
+  python bench.py --shared-chat --telegram-limits
+  python bench.py --micro-only > bench_output.txt
+
+The flow benchmark writes drafts and persistence keys, so point --redis-url at
+a scratch database (e.g. redis://localhost:6379/15).
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import statistics
+import time
+import timeit
+
+from aiohttp import web
+
+BENCH_TOKEN = "123456:bench"
+BENCH_CHANNEL_ID = "-1009999999999"
+BENCH_BANNER = "bench-banner-file-id"
+NOTES = (
+    "Fixed camera crash on boot\n"
+    "Updated kernel to the latest tag\n"
+    "Read the [changelog](https://example.com/changelog)\n"
+    "Clean flash recommended\n"
+    "Thanks to [testers](https://t.me/testers)"
+)
+
+# === CONFIG ===
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the release bot against local stand-ins.")
+    parser.add_argument("--maintainers", type=int, default=20, help="concurrent simulated maintainers")
+    parser.add_argument("--rounds", type=int, default=5, help="measured flows per maintainer")
+    parser.add_argument("--warmup", type=int, default=1, help="unmeasured flows per maintainer")
+    parser.add_argument("--devices", type=int, default=0, help="distinct codenames (default: one per maintainer)")
+    parser.add_argument("--ota-latency-ms", type=float, default=50)
+    parser.add_argument("--ota-jitter-ms", type=float, default=20)
+    parser.add_argument("--ota-error-rate", type=float, default=0.0, help="fraction of OTA requests answered 503")
+    parser.add_argument("--ota-cache-ttl", type=float, default=None, help="override OTA_CACHE_TTL (0 revalidates every /post)")
+    parser.add_argument("--tg-latency-ms", type=float, default=5)
+    parser.add_argument("--telegram-limits", action="store_true", help="keep the real Telegram rate limits")
+    parser.add_argument("--shared-chat", action="store_true", help="run every maintainer in one group chat")
+    parser.add_argument("--redis-url", default=None, help="Redis to use instead of fakeredis")
+    parser.add_argument("--micro-number", type=int, default=0, help="iterations per microbenchmark (default: auto)")
+    parser.add_argument("--micro-only", action="store_true")
+    parser.add_argument("--json", dest="json_path", default=None, help="also write the results to this file")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+def configure_env(args):
+    # main.py reads its configuration at import time
+    os.environ["BOT_TOKEN"] = BENCH_TOKEN
+    os.environ["CHANNEL_ID"] = BENCH_CHANNEL_ID
+    os.environ["REDIS_URL"] = args.redis_url or "redis://fakeredis"
+    chats = 1 if args.shared_chat else args.maintainers
+    os.environ["ALLOWED_CHAT_IDS"] = ",".join(str(chat_id_for(i)) for i in range(chats))
+    os.environ["ADMIN_USER_IDS"] = str(user_id_for(0))
+    if args.ota_cache_ttl is not None:
+        os.environ["OTA_CACHE_TTL"] = str(args.ota_cache_ttl)
+    if not args.telegram_limits:
+        os.environ["TG_GLOBAL_RATE"] = "1000000"
+        os.environ["TG_PRIVATE_CHAT_RATE"] = "1000000"
+        os.environ["TG_GROUP_RATE_PER_MINUTE"] = "1000000"
+
+def chat_id_for(index):
+    return -1001000000000 - index
+
+def user_id_for(index):
+    return 1000 + index
+
+def codename_for(index):
+    return f"bench{index:03d}"
+
+# === STAND-INS ===
+async def serve(app):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}"
+
+async def sleep_ms(latency_ms, jitter_ms=0):
+    delay = max(latency_ms + random.uniform(-jitter_ms, jitter_ms), 0) / 1000
+    if delay:
+        await asyncio.sleep(delay)
+
+def fake_updates_json(device_codename):
+    return json.dumps({"response": [{
+        "device": f"Bench Device {device_codename[-3:]}",
+        "version": "2.0",
+        "codename": "bench",
+        "timestamp": 1735689600,
+        "download": f"https://example.com/{device_codename}/AfterlifeOS-2.0.zip",
+        "size": 2_400_000_000,
+        "buildtype": "official",
+        "maintainer": f"maintainer_{device_codename}",
+        "telegram": f"https://t.me/maintainer_{device_codename}",
+        "forum": "https://t.me/afterlife_support",
+    }]})
+
+class FakeOtaServer:
+    """Serves updates.json with ETags, injected latency and injected 503s."""
+
+    def __init__(self, latency_ms, jitter_ms, error_rate):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.counters = {"requests": 0, "ok": 0, "not_modified": 0, "errors": 0}
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/{codename}/updates.json", self.handle)
+        return app
+
+    async def handle(self, request):
+        self.counters["requests"] += 1
+        await sleep_ms(self.latency_ms, self.jitter_ms)
+        if random.random() < self.error_rate:
+            self.counters["errors"] += 1
+            return web.Response(status=503)
+        etag = '"bench-2.0"'
+        if request.headers.get("If-None-Match") == etag:
+            self.counters["not_modified"] += 1
+            return web.Response(status=304)
+        self.counters["ok"] += 1
+        body = fake_updates_json(request.match_info["codename"])
+        return web.Response(text=body, content_type="application/json", headers={"ETag": etag})
+
+class FakeTelegram:
+    """Bot API stand-in. Every call is answered and kept in a per-chat outbox."""
+
+    def __init__(self, latency_ms):
+        self.latency_ms = latency_ms
+        self.message_ids = itertools.count(100000)
+        self.outbox = {}
+        self.calls = 0
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            data = await request.json()
+        else:
+            data = dict(await request.post())
+        self.calls += 1
+        await sleep_ms(self.latency_ms)
+
+        if method == "getMe":
+            return self.ok({"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"})
+        chat_id = str(data.get("chat_id", ""))
+        message_id = next(self.message_ids)
+        self.outbox.setdefault(chat_id, []).append((method, data, message_id))
+        if method.startswith("send"):
+            return self.ok({
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": int(chat_id), "type": "supergroup"},
+                "text": data.get("text", ""),
+            })
+        return self.ok(True)
+
+    @staticmethod
+    def ok(result):
+        return web.json_response({"ok": True, "result": result})
+
+    def mark(self, chat_id):
+        return len(self.outbox.get(str(chat_id), ()))
+
+    def find(self, chat_id, since, method, contains=None, reply_to=None):
+        for sent_method, data, message_id in self.outbox.get(str(chat_id), ())[since:]:
+            if sent_method != method:
+                continue
+            if contains and contains not in json.dumps(data):
+                continue
+            if reply_to is not None and reply_target(data) != reply_to:
+                continue
+            return data, message_id
+        return None, None
+
+def reply_target(data):
+    # Replies in groups quote the message they answer; form posts carry it as JSON text
+    params = data.get("reply_parameters") or {}
+    if isinstance(params, str):
+        params = json.loads(params)
+    return params.get("message_id")
+
+# === FLOW ===
+class Stats:
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.recording = True
+
+    def add(self, stage, seconds):
+        if self.recording:
+            self.samples.setdefault(stage, []).append(seconds)
+
+    def fail(self, stage):
+        if self.recording:
+            self.errors[stage] = self.errors.get(stage, 0) + 1
+
+class Maintainer:
+    update_ids = itertools.count(1)
+    message_ids = itertools.count(1)
+
+    def __init__(self, index, device_count, shared_chat=False):
+        self.user_id = user_id_for(index)
+        self.chat_id = chat_id_for(0 if shared_chat else index)
+        self.codename = codename_for(index % device_count)
+
+    def _user(self):
+        return {"id": self.user_id, "is_bot": False, "first_name": "Maintainer", "username": f"m{self.user_id}"}
+
+    def _chat(self):
+        return {"id": self.chat_id, "type": "supergroup"}
+
+    def command(self, text):
+        return {"update_id": next(self.update_ids), "message": {
+            "message_id": next(self.message_ids), "date": int(time.time()), "chat": self._chat(),
+            "from": self._user(), "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}],
+        }}
+
+    def reply(self, text, reply_to_message_id):
+        return {"update_id": next(self.update_ids), "message": {
+            "message_id": next(self.message_ids), "date": int(time.time()), "chat": self._chat(),
+            "from": self._user(), "text": text,
+            "reply_to_message": {
+                "message_id": reply_to_message_id, "date": int(time.time()), "chat": self._chat(), "text": "notes",
+            },
+        }}
+
+    def callback(self, data, message_id):
+        return {"update_id": next(self.update_ids), "callback_query": {
+            "id": str(next(self.update_ids)), "chat_instance": "bench", "data": data, "from": self._user(),
+            "message": {"message_id": message_id, "date": int(time.time()), "chat": self._chat(), "caption": "preview"},
+        }}
+
+    async def run(self, app, tg, stats):
+        """Runs one /post flow; returns True if the post reached the channel."""
+        flow_started = time.perf_counter()
+
+        async def stage(name, payload):
+            started = time.perf_counter()
+            await app.process_update(Update.de_json(payload, app.bot))
+            stats.add(name, time.perf_counter() - started)
+
+        # Replies are matched to this maintainer's messages, so chats can be shared
+        since = tg.mark(self.chat_id)
+        command = self.command(f"/post {self.codename}")
+        await stage("post", command)
+        preview, preview_id = tg.find(
+            self.chat_id, since, "sendPhoto", "notes_yes", reply_to=command["message"]["message_id"]
+        )
+        if not preview:
+            stats.fail("post")
+            return False
+        draft_id = json.loads(preview["reply_markup"])["inline_keyboard"][0][0]["callback_data"].split(":", 1)[1]
+
+        since = tg.mark(self.chat_id)
+        await stage("notes_yes", self.callback(f"notes_yes:{draft_id}", preview_id))
+        _, prompt_id = tg.find(self.chat_id, since, "sendMessage", reply_to=preview_id)
+        if not prompt_id:
+            stats.fail("notes_yes")
+            return False
+
+        since = tg.mark(self.chat_id)
+        await stage("notes_reply", self.reply(NOTES, prompt_id))
+        edited, _ = tg.find(self.chat_id, since, "editMessageCaption", f"confirm_send:{draft_id}")
+        if not edited:
+            stats.fail("notes_reply")
+            return False
+
+        since = tg.mark(self.chat_id)
+        await stage("confirm_send", self.callback(f"confirm_send:{draft_id}", preview_id))
+        done, _ = tg.find(self.chat_id, since, "sendMessage", "successfully", reply_to=preview_id)
+        if not done:
+            stats.fail("confirm_send")
+            return False
+
+        stats.add("flow", time.perf_counter() - flow_started)
+        return True
+
+async def run_flows(args):
+    ota = FakeOtaServer(args.ota_latency_ms, args.ota_jitter_ms, args.ota_error_rate)
+    tg = FakeTelegram(args.tg_latency_ms)
+    ota_runner, ota_url = await serve(ota.app())
+    tg_runner, tg_url = await serve(tg.app())
+    # Picked up when setup_bot_data loads the settings
+    os.environ["BASE_URL"] = ota_url
+
+    if args.redis_url:
+        redis_client = main.redis.Redis.from_pool(main.redis.BlockingConnectionPool.from_url(
+            args.redis_url, decode_responses=True, max_connections=main.REDIS_MAX_CONNECTIONS
+        ))
+    else:
+        try:
+            import fakeredis
+        except ImportError:
+            print("[ERROR] fakeredis is not installed. Install it or pass --redis-url.")
+            return None
+        redis_client = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    http_client = main.PooledHttpClient()
+
+    # Same wiring as main(), minus the update source and scheduled jobs
+    app = (
+        ApplicationBuilder()
+        .token(BENCH_TOKEN)
+        .base_url(f"{tg_url}/bot")
+        .rate_limiter(main.SendDispatcher())
+        .persistence(main.RedisPersistence(redis_client))
+        .context_types(ContextTypes(bot_data=main.BotData))
+        .build()
+    )
+    for handler in main.build_handlers():
+        app.add_handler(handler)
+    await app.initialize()
+    await main.setup_bot_data(app, redis_client, http_client)
+    device_count = args.devices or args.maintainers
+    for index in range(device_count):
+        app.bot_data["device_index"].update(codename_for(index), {})
+    await app.bot_data["banner_cache"].set(main.banner_field(), BENCH_BANNER)
+    await app.start()
+
+    stats = Stats()
+    maintainers = [Maintainer(i, device_count, args.shared_chat) for i in range(args.maintainers)]
+
+    async def run_rounds(maintainer, rounds):
+        for _ in range(rounds):
+            await maintainer.run(app, tg, stats)
+
+    stats.recording = False
+    await asyncio.gather(*(run_rounds(m, args.warmup) for m in maintainers))
+    stats.recording = True
+    ota_before = dict(ota.counters)
+    tg_before = tg.calls
+    started = time.perf_counter()
+    await asyncio.gather(*(run_rounds(m, args.rounds) for m in maintainers))
+    wall = time.perf_counter() - started
+
+    results = {
+        "wall_seconds": wall,
+        "stages": summarize(stats, wall),
+        "ota_requests": {k: v - ota_before[k] for k, v in ota.counters.items()},
+        "telegram_calls": tg.calls - tg_before,
+        "dispatcher": app.bot.rate_limiter.stats(),
+        "circuit": app.bot_data["ota_cache"].breaker.state,
+    }
+
+    await app.stop()
+    await app.shutdown()
+    await http_client.aclose()
+    await redis_client.aclose()
+    await ota_runner.cleanup()
+    await tg_runner.cleanup()
+    return results
+
+# === REPORT ===
+STAGES = ("post", "notes_yes", "notes_reply", "confirm_send", "flow")
+
+def percentile(sorted_samples, pct):
+    # Nearest-rank percentile
+    index = max(int(round(pct / 100 * len(sorted_samples) + 0.5)) - 1, 0)
+    return sorted_samples[min(index, len(sorted_samples) - 1)]
+
+def summarize(stats, wall):
+    summary = {}
+    for stage in STAGES:
+        samples = sorted(stats.samples.get(stage, []))
+        errors = stats.errors.get(stage, 0)
+        if not samples:
+            summary[stage] = {"count": 0, "errors": errors}
+            continue
+        summary[stage] = {
+            "count": len(samples),
+            "errors": errors,
+            "mean_ms": statistics.fmean(samples) * 1000,
+            "p50_ms": percentile(samples, 50) * 1000,
+            "p95_ms": percentile(samples, 95) * 1000,
+            "p99_ms": percentile(samples, 99) * 1000,
+            "max_ms": samples[-1] * 1000,
+            "per_second": len(samples) / wall if wall else 0.0,
+        }
+    return summary
+
+def print_flow_report(args, results):
+    chats = "one shared chat" if args.shared_chat else "own chats"
+    print(f"Flow benchmark: {args.maintainers} maintainers x {args.rounds} rounds in {chats} "
+          f"(OTA {args.ota_latency_ms:.0f}±{args.ota_jitter_ms:.0f} ms, {args.ota_error_rate:.0%} errors; "
+          f"Telegram {args.tg_latency_ms:.0f} ms; Redis: {args.redis_url or 'fakeredis'})")
+    print(f"{'stage':<14}{'count':>7}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'ops/s':>10}")
+    for stage, row in results["stages"].items():
+        if not row["count"]:
+            print(f"{stage:<14}{0:>7}{row['errors']:>8}")
+            continue
+        print(
+            f"{stage:<14}{row['count']:>7}{row['errors']:>8}{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}"
+            f"{row['p99_ms']:>10.1f}{row['max_ms']:>10.1f}{row['per_second']:>10.1f}"
+        )
+    print(f"Wall time: {results['wall_seconds']:.2f}s, OTA: {results['ota_requests']}, "
+          f"Telegram calls: {results['telegram_calls']}, circuit: {results['circuit']}")
+    print(f"Dispatcher: {results['dispatcher']}")
+
+# === MICROBENCHMARKS ===
+def run_micro(args):
+    data = main.parse_rom_data("bench000", json.loads(fake_updates_json("bench000")))
+    notes = main.parse_notes(NOTES)
+
+    def uncached(render):
+        # post_fields caches per record, so a repeated call would only time the
+        # cache hit; clearing it first times the first render of a record
+        def case():
+            main._post_fields.cache_clear()
+            return render()
+        return case
+
+    cases = {
+        "format_post": uncached(lambda: main.format_post(data, "maintainer")),
+        "format_post+notes": uncached(lambda: main.format_post(data, "maintainer", notes)),
+        "render_post_targets": uncached(lambda: main.render_post_targets(data, "maintainer", notes)),
+        "format_post (cached)": lambda: main.format_post(data, "maintainer"),
+        "render_post_targets (cached)": lambda: main.render_post_targets(data, "maintainer", notes),
+        "parse_notes": lambda: main.parse_notes(NOTES),
+        "build_keyboard": lambda: main.build_keyboard(data),
+    }
+    results = {}
+    for name, case in cases.items():
+        timer = timeit.Timer(case)
+        number = args.micro_number or timer.autorange()[0]
+        best = min(timer.repeat(repeat=5, number=number)) / number
+        results[name] = {"iterations": number, "us_per_op": best * 1e6}
+    return results
+
+def print_micro_report(results):
+    print("Microbenchmarks (best of 5):")
+    for name, row in results.items():
+        print(f"  {name:<30}{row['us_per_op']:>10.2f} us/op  ({row['iterations']} iterations)")
+
+async def run(args):
+    results = {}
+    if not args.micro_only:
+        flows = await run_flows(args)
+        if flows is None:
+            return
+        results["flows"] = flows
+        print_flow_report(args, flows)
+        print()
+    results["micro"] = run_micro(args)
+    print_micro_report(results["micro"])
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    ARGS = parse_args()
+    random.seed(ARGS.seed)
+    configure_env(ARGS)
+    import main
+    from telegram import Update
+    from telegram.ext import ApplicationBuilder, ContextTypes
+    asyncio.run(run(ARGS))
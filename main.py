@@ -1,158 +1,1400 @@
 import os
-import requests
+import httpx
 import asyncio
-from datetime import datetime
+import bisect
+import contextvars
+import functools
+import heapq
+import hmac
+import html
+import importlib.util
+import itertools
+import json
+import secrets
+import signal
+import string
+import time
+from collections import OrderedDict, deque
+from copy import deepcopy
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 import re
-import redis
-from functools import partial
+import redis.asyncio as redis
+from redis.exceptions import RedisError
 
 from telegram import (
-    Update, InlineKeyboardButton, InlineKeyboardMarkup, Bot, ForceReply
+    Update, InlineKeyboardButton, InlineKeyboardMarkup, ForceReply,
+    InlineQueryResultArticle, InlineQueryResultCachedPhoto, InputTextMessageContent
 )
 from telegram.ext import (
-    ApplicationBuilder, CommandHandler, CallbackQueryHandler, ContextTypes,
-    MessageHandler, filters
+    ApplicationBuilder, BasePersistence, BaseRateLimiter, BaseUpdateProcessor,
+    CallbackQueryHandler, CommandHandler, ContextTypes, InlineQueryHandler,
+    MessageHandler, PersistenceInput, TypeHandler, filters
 )
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter
 from dotenv import load_dotenv
 
 # === CONFIGURATION ===
 load_dotenv(dotenv_path='private.env')
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
-CHANNEL_ID = os.environ.get("CHANNEL_ID")
+# ALLOWED_CHAT_IDS, ADMIN_USER_IDS, CHANNEL_ID, POST_TARGETS, OTA_WATCH_CHAT_ID
+# and BASE_URL can be changed at runtime, see RUNTIME SETTINGS
 REDIS_URL = os.environ.get("REDIS_URL")
-BASE_URL = "https://raw.githubusercontent.com/AfterlifeOS/device_afterlife_ota/refs/heads/16"
+REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", "20"))
+REDIS_POOL_TIMEOUT = float(os.environ.get("REDIS_POOL_TIMEOUT", "5"))
 DONATE_URL = "https://t.me/donate_zero/6"
 AFL_SUPPORT = "https://t.me/AfterLifeOS"
 SOURCE_CHANGELOGS_URL = "https://github.com/AfterlifeOS/Release_changelogs/blob/main/AfterLife-Changelogs.mk"
+OTA_TREE_URL = "https://api.github.com/repos/AfterlifeOS/device_afterlife_ota/git/trees/16"
+CAPTION_LIMIT = 1024
+
+# Bulk release mode (/postall and /post with several codenames)
+BULK_FETCH_CONCURRENCY = int(os.environ.get("BULK_FETCH_CONCURRENCY", "8"))
+
+# HTTP client (shared keep-alive pool for the OTA source)
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "3"))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", "10"))
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "50"))
+HTTP_MAX_PER_HOST = int(os.environ.get("HTTP_MAX_PER_HOST", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", "60"))
+
+# OTA cache (memory LRU in front of a Redis tier shared by replicas)
+OTA_CACHE_TTL = float(os.environ.get("OTA_CACHE_TTL", "60"))
+OTA_CACHE_MAX_ENTRIES = int(os.environ.get("OTA_CACHE_MAX_ENTRIES", "512"))
+OTA_CACHE_REDIS_TTL = int(os.environ.get("OTA_CACHE_REDIS_TTL", "86400"))
+# How long a request waits on revalidation before the cached copy is served as stale
+OTA_STALE_GRACE = float(os.environ.get("OTA_STALE_GRACE", "1.5"))
+
+# Circuit breaker for the OTA source
+OTA_BREAKER_WINDOW = int(os.environ.get("OTA_BREAKER_WINDOW", "20"))
+OTA_BREAKER_MIN_CALLS = int(os.environ.get("OTA_BREAKER_MIN_CALLS", "5"))
+OTA_BREAKER_ERROR_RATE = float(os.environ.get("OTA_BREAKER_ERROR_RATE", "0.5"))
+OTA_BREAKER_SLOW_CALL = float(os.environ.get("OTA_BREAKER_SLOW_CALL", "3"))
+OTA_BREAKER_SLOW_RATE = float(os.environ.get("OTA_BREAKER_SLOW_RATE", "0.5"))
+OTA_BREAKER_COOLDOWN = float(os.environ.get("OTA_BREAKER_COOLDOWN", "30"))
+
+# Outbound Telegram limits (see https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this)
+TG_GLOBAL_RATE = float(os.environ.get("TG_GLOBAL_RATE", "30"))
+TG_PRIVATE_CHAT_RATE = float(os.environ.get("TG_PRIVATE_CHAT_RATE", "1"))
+TG_GROUP_RATE_PER_MINUTE = float(os.environ.get("TG_GROUP_RATE_PER_MINUTE", "20"))
+TG_MAX_RETRIES = int(os.environ.get("TG_MAX_RETRIES", "3"))
+TG_QUEUE_WARN_DEPTH = int(os.environ.get("TG_QUEUE_WARN_DEPTH", "50"))
+
+# Device index refresh from the OTA repository tree (0 disables it)
+DEVICE_INDEX_REFRESH_INTERVAL = int(os.environ.get("DEVICE_INDEX_REFRESH_INTERVAL", "3600"))
+
+# Background OTA watcher (0 disables it)
+OTA_WATCH_INTERVAL = int(os.environ.get("OTA_WATCH_INTERVAL", "300"))
+
+# Inline mode (@bot <codename>)
+INLINE_RESULTS_LIMIT = int(os.environ.get("INLINE_RESULTS_LIMIT", "20"))
+INLINE_CACHE_TIME = int(os.environ.get("INLINE_CACHE_TIME", "10"))
+
+# Concurrent update handling
+MAX_CONCURRENT_UPDATES = int(os.environ.get("MAX_CONCURRENT_UPDATES", "32"))
+SHUTDOWN_DRAIN_TIMEOUT = float(os.environ.get("SHUTDOWN_DRAIN_TIMEOUT", "30"))
+
+# Update source: "polling" (default) or "webhook"
+BOT_MODE = os.environ.get("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8080"))
+# Every replica must check the same secret, so without one set it is derived from the token
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or hmac.new(
+    (BOT_TOKEN or "").encode(), b"webhook-secret", "sha256"
+).hexdigest()
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+# Shared user/chat/bot data in Redis, so any worker can continue a conversation
+PERSISTENCE_TTL = int(os.environ.get("PERSISTENCE_TTL", str(7 * 86400)))
+PERSISTENCE_UPDATE_INTERVAL = float(os.environ.get("PERSISTENCE_UPDATE_INTERVAL", "1"))
+
+# Process role: "all" (default), "ingress" (receive and enqueue updates only)
+# or "worker" (run handlers for the stream shards it owns)
+BOT_ROLE = os.environ.get("BOT_ROLE", "all").lower()
+WORKER_INDEX = int(os.environ.get("WORKER_INDEX", "0"))
+WORKER_COUNT = int(os.environ.get("WORKER_COUNT", "1"))
+STREAM_SHARDS = int(os.environ.get("STREAM_SHARDS", "16"))
+STREAM_GROUP = os.environ.get("STREAM_GROUP", "workers")
+STREAM_MAXLEN = int(os.environ.get("STREAM_MAXLEN", "10000"))
+STREAM_BATCH = int(os.environ.get("STREAM_BATCH", "10"))
+STREAM_BLOCK_MS = int(os.environ.get("STREAM_BLOCK_MS", "5000"))
+STREAM_MAX_DELIVERIES = int(os.environ.get("STREAM_MAX_DELIVERIES", "5"))
+STREAM_CLAIM_IDLE_MS = int(os.environ.get("STREAM_CLAIM_IDLE_MS", "60000"))
+
+# Post drafts (preview -> notes -> confirm) are kept in Redis for this long
+DRAFT_TTL = int(os.environ.get("DRAFT_TTL", "86400"))
+
+# Scheduled posts: times typed by maintainers are read in SCHEDULE_TZ
+SCHEDULE_TZ = os.environ.get("SCHEDULE_TZ", "UTC")
+SCHEDULE_BATCH = int(os.environ.get("SCHEDULE_BATCH", "10"))
+SCHEDULE_LEASE = int(os.environ.get("SCHEDULE_LEASE", "300"))
+SCHEDULE_MAX_SLEEP = float(os.environ.get("SCHEDULE_MAX_SLEEP", "60"))
+SCHEDULE_MAX_DAYS = int(os.environ.get("SCHEDULE_MAX_DAYS", "30"))
+
+# Post history: entries kept per device, rows shown by /history and /latest
+HISTORY_PER_DEVICE = int(os.environ.get("HISTORY_PER_DEVICE", "20"))
+HISTORY_LIST_LIMIT = int(os.environ.get("HISTORY_LIST_LIMIT", "10"))
+
+# Metrics: Prometheus endpoint (0 disables it) and slow-update tracing (0 disables it)
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "127.0.0.1")
+TRACE_SLOW_UPDATES_MS = float(os.environ.get("TRACE_SLOW_UPDATES_MS", "0"))
+
+try:
+    SCHEDULE_ZONE = ZoneInfo(SCHEDULE_TZ)
+except ZoneInfoNotFoundError:
+    print(f"[WARNING] Unknown SCHEDULE_TZ '{SCHEDULE_TZ}', using UTC.")
+    SCHEDULE_ZONE = ZoneInfo("UTC")
+
+# Probed without importing h2; httpx only loads it when a client is built
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
 
-# Allowed Chat
-allowed_ids_str = os.environ.get("ALLOWED_CHAT_IDS", "")
-temp_ids_list = allowed_ids_str.split(",")
-ALLOWED_CHAT_IDS = []
+if not REDIS_URL:
+    print("[ERROR] REDIS_URL is not set in environment. Bot cannot start.")
+else:
+    print(f"REDIS_URL loaded. Will attempt to connect.")
 
-for item in temp_ids_list:
-    item_stripped = item.strip()
-    if item_stripped:
+# === METRICS ===
+# Process-wide counters, gauges and latency histograms. METRICS.timer() wraps
+# handlers, OTA fetches, Redis commands and Telegram calls; with
+# TRACE_SLOW_UPDATES_MS set, the same timers also record spans for the update
+# being handled and slow updates are printed with their breakdown.
+METRICS_PREFIX = "releasebot"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+CURRENT_TRACE = contextvars.ContextVar("current_trace", default=None)
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate interpolated within the bucket, like histogram_quantile()."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = LATENCY_BUCKETS[i - 1] if i else 0.0
+                upper = LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else LATENCY_BUCKETS[-1]
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return LATENCY_BUCKETS[-1]
+
+class Timer:
+    __slots__ = ("metrics", "name", "labels", "started")
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.started
+        self.metrics.observe(self.name, elapsed, **self.labels)
+        if exc_type is not None and not issubclass(exc_type, asyncio.CancelledError):
+            self.metrics.inc(f"{self.name}_errors", **self.labels)
+        trace = CURRENT_TRACE.get()
+        if trace is not None:
+            label = " ".join(str(v) for v in self.labels.values())
+            trace.append((f"{self.name} {label}".strip(), self.started, elapsed, exc_type is not None))
+        return False
+
+class Metrics:
+    """Registry rendered in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.started_at = time.time()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    def timer(self, name, **labels):
+        return Timer(self, name, labels)
+
+    def gauge(self, name, read):
+        """`read()` returns a number, or a dict of {((label, value), ...): number}."""
+        self.gauges[name] = read
+
+    def counter(self, name, **labels):
+        return self.counters.get(self._key(name, labels), 0)
+
+    def counters_by(self, name, label):
+        values = {}
+        for (metric, labels), value in self.counters.items():
+            if metric == name:
+                values[dict(labels).get(label)] = value
+        return values
+
+    def histogram(self, name, **labels):
+        """Merges every series of `name` matching `labels`."""
+        merged = Histogram()
+        for (metric, series), histogram in self.histograms.items():
+            if metric != name or any(dict(series).get(k) != v for k, v in labels.items()):
+                continue
+            merged.counts = [a + b for a, b in zip(merged.counts, histogram.counts)]
+            merged.sum += histogram.sum
+            merged.count += histogram.count
+        return merged
+
+    def histogram_labels(self, name, label):
+        return sorted({dict(series).get(label) for metric, series in self.histograms if metric == name} - {None})
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = [*labels, *extra]
+        if not pairs:
+            return ""
+        escaped = []
+        for k, v in pairs:
+            v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            escaped.append(f'{k}="{v}"')
+        return "{" + ",".join(escaped) + "}"
+
+    def render(self):
+        lines = []
+        typed = set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(self.counters.items()):
+            full = f"{METRICS_PREFIX}_{name}_total"
+            header(full, "counter")
+            lines.append(f"{full}{self._labels(labels)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            full = f"{METRICS_PREFIX}_{name}_seconds"
+            header(full, "histogram")
+            cumulative = 0
+            for bound, bucket_count in zip((*LATENCY_BUCKETS, "+Inf"), histogram.counts):
+                cumulative += bucket_count
+                lines.append(f"{full}_bucket{self._labels(labels, (('le', bound),))} {cumulative}")
+            lines.append(f"{full}_sum{self._labels(labels)} {histogram.sum}")
+            lines.append(f"{full}_count{self._labels(labels)} {histogram.count}")
+        for name, read in sorted(self.gauges.items()):
+            full = f"{METRICS_PREFIX}_{name}"
+            try:
+                value = read()
+            except Exception as e:
+                print(f"[WARNING] Gauge {name} failed: {e}")
+                continue
+            header(full, "gauge")
+            if isinstance(value, dict):
+                for labels, v in sorted(value.items()):
+                    lines.append(f"{full}{self._labels(labels)} {v}")
+            else:
+                lines.append(f"{full} {value}")
+        lines.append(f"# TYPE {METRICS_PREFIX}_uptime_seconds gauge")
+        lines.append(f"{METRICS_PREFIX}_uptime_seconds {time.time() - self.started_at:.0f}")
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+
+def instrument_handler(callback):
+    """Times a handler callback and, when tracing is on, reports slow updates span by span."""
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        METRICS.inc("handler_calls", handler=name)
+        if TRACE_SLOW_UPDATES_MS <= 0:
+            with METRICS.timer("handler", handler=name):
+                return await callback(update, context)
+
+        spans = []
+        token = CURRENT_TRACE.set(spans)
+        started = time.perf_counter()
         try:
-            ALLOWED_CHAT_IDS.append(int(item_stripped))
-        except ValueError:
-            print(f"[WARNING] Ignoring invalid ID in ALLOWED_CHAT_IDS: {item_stripped}")
+            with METRICS.timer("handler", handler=name):
+                return await callback(update, context)
+        finally:
+            CURRENT_TRACE.reset(token)
+            total_ms = (time.perf_counter() - started) * 1000
+            if total_ms >= TRACE_SLOW_UPDATES_MS:
+                print_trace(name, update, started, total_ms, spans)
+
+    return wrapper
+
+def print_trace(name, update, started, total_ms, spans):
+    update_id = getattr(update, "update_id", "?")
+    lines = [f"[TRACE] {name} took {total_ms:.0f}ms (update {update_id})"]
+    for span_name, span_started, elapsed, failed in sorted(spans, key=lambda span: span[1]):
+        if span_name.startswith(f"handler {name}"):
+            continue
+        offset_ms = (span_started - started) * 1000
+        lines.append(f"  +{offset_ms:7.1f}ms {elapsed * 1000:8.1f}ms  {span_name}{' (failed)' if failed else ''}")
+    print("\n".join(lines))
+
+async def start_metrics_server():
+    """Serves GET /metrics on METRICS_LISTEN:METRICS_PORT."""
+    from aiohttp import web
+
+    async def metrics(request):
+        return web.Response(text=METRICS.render(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Content-Type-Options": "nosniff"})
+
+    web_app = web.Application()
+    web_app.router.add_get("/metrics", metrics)
+    runner = web.AppRunner(web_app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_LISTEN, METRICS_PORT).start()
+    print(f"Metrics available on http://{METRICS_LISTEN}:{METRICS_PORT}/metrics")
+    return runner
+
+# === REDIS HELPERS ===
+class RedisUnavailableError(Exception):
+    """Raised when Redis cannot serve a command (as opposed to a missing key)."""
+
+async def run_redis_command(redis_client, command_name, *args, **kwargs):
+    """
+    Runs a redis command on the shared asyncio connection pool.
+    Raises RedisUnavailableError on failure, so a Redis outage is not
+    mistaken for a key that is simply not set.
+    """
+    try:
+        command_method = getattr(redis_client, command_name)
+        with METRICS.timer("redis_command", command=command_name):
+            return await command_method(*args, **kwargs)
+    except RedisError as e:
+        print(f"[ERROR] Redis command '{command_name}' failed: {e}")
+        raise RedisUnavailableError(f"Redis command '{command_name}' failed: {e}") from e
+
+async def run_redis_pipeline(redis_client, build, transaction=False):
+    """
+    Queues several commands with `build(pipe)` and sends them in a single
+    round trip. Returns the list of replies in queue order.
+    """
+    try:
+        async with redis_client.pipeline(transaction=transaction) as pipe:
+            build(pipe)
+            with METRICS.timer("redis_command", command="pipeline"):
+                return await pipe.execute()
+    except RedisError as e:
+        print(f"[ERROR] Redis pipeline failed: {e}")
+        raise RedisUnavailableError(f"Redis pipeline failed: {e}") from e
+
+async def run_redis_script(script, keys=(), args=()):
+    """Runs a Lua script registered with `redis_client.register_script`."""
+    try:
+        with METRICS.timer("redis_command", command="script"):
+            return await script(keys=list(keys), args=list(args))
+    except RedisError as e:
+        print(f"[ERROR] Redis script failed: {e}")
+        raise RedisUnavailableError(f"Redis script failed: {e}") from e
+
+# === HTTP CLIENT ===
+class PooledHttpClient:
+    """
+    Async HTTP client shared for the application's lifetime. Connections are
+    kept alive (HTTP/2 when available) and each host gets its own cap on
+    concurrent requests, so one slow host cannot starve the pool.
+    """
 
-print(f"Successfully loaded {len(ALLOWED_CHAT_IDS)} Chat IDs: {ALLOWED_CHAT_IDS}")
+    def __init__(self, max_per_host=HTTP_MAX_PER_HOST):
+        self.max_per_host = max_per_host
+        self._host_slots = {}
+        self._client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(
+                connect=HTTP_CONNECT_TIMEOUT,
+                read=HTTP_READ_TIMEOUT,
+                write=HTTP_READ_TIMEOUT,
+                pool=HTTP_CONNECT_TIMEOUT,
+            ),
+            follow_redirects=True,
+        )
 
-# User as Admin
-admin_ids_str = os.environ.get("ADMIN_USER_IDS", "")
-temp_admin_list = admin_ids_str.split(",")
-ADMIN_USER_IDS = []
+    def _slots_for(self, url):
+        host = httpx.URL(url).host
+        slots = self._host_slots.get(host)
+        if slots is None:
+            slots = self._host_slots[host] = asyncio.Semaphore(self.max_per_host)
+        return slots
+
+    async def get(self, url, **kwargs):
+        async with self._slots_for(url):
+            return await self._client.get(url, **kwargs)
+
+    async def aclose(self):
+        await self._client.aclose()
+
+# === OUTBOUND DISPATCHER ===
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+# Only these kinds of requests count against Telegram's message limits
+RATE_LIMITED_ENDPOINT_PREFIXES = ("send", "edit", "copy", "forward")
+# Of those, only new messages count against a chat's own limit; edits are
+# paced by the global bucket and RetryAfter
+CHAT_LIMITED_ENDPOINT_PREFIXES = ("send", "copy", "forward")
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class SendDispatcher(BaseRateLimiter):
+    """
+    Rate limiter plugged into the application's bot, so every Bot API call
+    shares one outbound queue. New messages take a token from a per-chat
+    bucket, then they and edits take one from the global bucket; the global bucket is
+    handed out by priority, so interactive replies overtake bulk channel
+    posts. RetryAfter pauses the queue and the request is retried.
+
+    Pass `rate_limit_args={"priority": PRIORITY_BULK}` for bulk sends.
+    """
+
+    def __init__(self):
+        self._global_bucket = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE)
+        self._chat_buckets = {}
+        self._queue = []
+        self._sequence = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._paused_until = 0.0
+        self._drain_task = None
+        self._in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.counters = {"sent": 0, "retried": 0, "failed": 0}
+
+    async def initialize(self):
+        if self._drain_task is None:
+            self._drain_task = asyncio.create_task(self._drain())
+
+    async def shutdown(self):
+        # Let requests that are already queued or on the wire finish first
+        if self._in_flight:
+            print(f"Waiting for {self._in_flight} pending Telegram requests...")
+            try:
+                await asyncio.wait_for(self._idle.wait(), SHUTDOWN_DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                print(f"[WARNING] {self._in_flight} Telegram requests still pending at shutdown.")
+        if self._drain_task is not None:
+            self._drain_task.cancel()
+            try:
+                await self._drain_task
+            except asyncio.CancelledError:
+                pass
+            self._drain_task = None
+        for _, _, future in self._queue:
+            if not future.done():
+                future.cancel()
+        self._queue.clear()
+
+    def queue_depth(self, priority=None):
+        if priority is None:
+            return len(self._queue)
+        return sum(1 for p, _, _ in self._queue if p == priority)
+
+    def stats(self):
+        return {
+            "queued_interactive": self.queue_depth(PRIORITY_INTERACTIVE),
+            "queued_bulk": self.queue_depth(PRIORITY_BULK),
+            "in_flight": self._in_flight,
+            **self.counters,
+        }
 
-for item in temp_admin_list:
-    item_stripped = item.strip()
-    if item_stripped:
+    def _bucket_for(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                self._chat_buckets = {k: b for k, b in self._chat_buckets.items() if not b.is_full()}
+            is_group = str(chat_id).startswith(("-", "@"))
+            if is_group:
+                bucket = TokenBucket(TG_GROUP_RATE_PER_MINUTE / 60, TG_GROUP_RATE_PER_MINUTE)
+            else:
+                bucket = TokenBucket(TG_PRIVATE_CHAT_RATE, 1)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def _drain(self):
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            await self._global_bucket.acquire()
+            _, _, future = heapq.heappop(self._queue)
+            if not future.done():
+                future.set_result(None)
+
+    async def _wait_turn(self, priority):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._sequence), future))
+        self._wakeup.set()
+        depth = len(self._queue)
+        if depth >= TG_QUEUE_WARN_DEPTH and depth % TG_QUEUE_WARN_DEPTH == 0:
+            print(f"[WARNING] Outbound send queue depth is {depth}: {self.stats()}")
+        await future
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        self._in_flight += 1
+        self._idle.clear()
         try:
-            ADMIN_USER_IDS.append(int(item_stripped))
-        except ValueError:
-            print(f"[WARNING] Ignoring invalid ID in ADMIN_USER_IDS: {item_stripped}")
+            with METRICS.timer("telegram_request", endpoint=endpoint):
+                return await self._process_request(callback, args, kwargs, endpoint, data, rate_limit_args)
+        finally:
+            self._in_flight -= 1
+            if not self._in_flight:
+                self._idle.set()
+
+    async def _process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = (rate_limit_args or {}).get("priority", PRIORITY_INTERACTIVE)
+        limited = endpoint.startswith(RATE_LIMITED_ENDPOINT_PREFIXES)
+        chat_id = data.get("chat_id") if endpoint.startswith(CHAT_LIMITED_ENDPOINT_PREFIXES) else None
+
+        for attempt in range(TG_MAX_RETRIES + 1):
+            if limited:
+                if chat_id is not None:
+                    await self._bucket_for(chat_id).acquire()
+                await self._wait_turn(priority)
+            try:
+                result = await callback(*args, **kwargs)
+                self.counters["sent"] += 1
+                return result
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                if attempt == TG_MAX_RETRIES:
+                    self.counters["failed"] += 1
+                    raise
+                print(f"[WARNING] Flood control on {endpoint}, retrying in {retry_after}s")
+                self.counters["retried"] += 1
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                await asyncio.sleep(retry_after)
+            except Exception:
+                self.counters["failed"] += 1
+                raise
+
+# === UPDATE PROCESSING ===
+class OrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes up to `max_concurrent_updates` updates at once, while updates
+    from the same user in the same chat still run one after another in
+    arrival order (so a notes reply cannot race the callback before it).
+    Shutdown waits for updates that are still being handled.
+    """
 
-if not ADMIN_USER_IDS:
-    print("[WARNING] ADMIN_USER_IDS is not set. Banner commands will not be usable by anyone.")
-else:
-    print(f"Successfully loaded {len(ADMIN_USER_IDS)} Admin IDs: {ADMIN_USER_IDS}")
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._tails = {}
+        self._in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    @staticmethod
+    def ordering_key(update):
+        if not isinstance(update, Update) or update.inline_query or not update.effective_user:
+            return None
+        chat_id = update.effective_chat.id if update.effective_chat else None
+        return chat_id, update.effective_user.id
+
+    async def process_update(self, update, coroutine):
+        # Replaces the base version, which takes a concurrency slot before
+        # do_process_update. Here an update first waits for the previous one
+        # with its key, so a burst from one user cannot fill every slot with
+        # updates that are only waiting and stall all other users.
+        self._in_flight += 1
+        self._idle.clear()
+        key = self.ordering_key(update)
+        previous = self._tails.get(key) if key is not None else None
+        done = asyncio.get_running_loop().create_future()
+        if key is not None:
+            self._tails[key] = done
+        try:
+            if previous is not None:
+                with METRICS.timer("update_ordering_wait"):
+                    await previous
+            async with self._slots:
+                await self.do_process_update(update, coroutine)
+        except asyncio.CancelledError:
+            coroutine.close()
+            raise
+        finally:
+            done.set_result(None)
+            if key is not None and self._tails.get(key) is done:
+                del self._tails[key]
+            self._in_flight -= 1
+            if not self._in_flight:
+                self._idle.set()
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        if self._in_flight:
+            print(f"Waiting for {self._in_flight} updates still being processed...")
+            try:
+                await asyncio.wait_for(self._idle.wait(), SHUTDOWN_DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                print(f"[WARNING] {self._in_flight} updates still running at shutdown.")
 
-if not REDIS_URL:
-    print("[ERROR] REDIS_URL is not set in environment. Bot cannot start.")
-else:
-    print(f"REDIS_URL loaded. Will attempt to connect.")
+# === PERSISTENCE ===
+class BotData(dict):
+    """
+    bot_data that deep-copies (and therefore persists) only JSON-safe values.
+    Process-local objects such as the Redis and HTTP clients stay in memory.
+    """
 
-# === NEW REDIS FUNCTION ===
-async def run_redis_command(redis_client, command_name, *args, **kwargs):
+    def __deepcopy__(self, memo):
+        copy = BotData()
+        for key, value in self.items():
+            try:
+                json.dumps(value)
+            except (TypeError, ValueError):
+                continue
+            copy[key] = deepcopy(value, memo)
+        return copy
+
+class RedisPersistence(BasePersistence):
     """
-    Runs a synchronous redis command in a thread pool to avoid
-    blocking the asyncio event loop.
+    Stores user_data, chat_data and bot_data as Redis hashes (one JSON
+    encoded field per key) with a TTL. Data is re-read from Redis right
+    before each handler runs, so several workers serving one bot token see
+    each other's changes, and only fields that changed are written back.
+
+    Values that are not JSON serializable (e.g. the Redis client kept in
+    bot_data) are process-local and never persisted.
     """
-    try:
-        command_method = getattr(redis_client, command_name)
-        sync_call = partial(command_method, *args, **kwargs)
 
-        return await asyncio.to_thread(sync_call)
-    except Exception as e:
-        print(f"[ERROR] Redis command '{command_name}' failed: {e}")
+    def __init__(self, redis_client, ttl=PERSISTENCE_TTL, update_interval=PERSISTENCE_UPDATE_INTERVAL):
+        super().__init__(store_data=PersistenceInput(callback_data=False), update_interval=update_interval)
+        self.redis_client = redis_client
+        self.ttl = ttl
+        # What Redis is known to hold for each key, as encoded fields
+        self._snapshots = {}
+        self._bot_data_refreshed_at = 0.0
+
+    @staticmethod
+    def _key(kind, ident=None):
+        return f"persist:{kind}" if ident is None else f"persist:{kind}:{ident}"
+
+    @staticmethod
+    def _encode(data):
+        encoded = {}
+        for field, value in data.items():
+            try:
+                encoded[str(field)] = json.dumps(value, sort_keys=True)
+            except (TypeError, ValueError):
+                continue
+        return encoded
+
+    async def _write(self, key, data):
+        encoded = self._encode(data)
+        snapshot = self._snapshots.get(key, {})
+        changed = {f: v for f, v in encoded.items() if snapshot.get(f) != v}
+        removed = [f for f in snapshot if f not in encoded]
+        if not changed and not removed:
+            return
+
+        def build(pipe):
+            if changed:
+                pipe.hset(key, mapping=changed)
+            if removed:
+                pipe.hdel(key, *removed)
+            pipe.expire(key, self.ttl)
+
+        try:
+            await run_redis_pipeline(self.redis_client, build)
+        except RedisUnavailableError:
+            return
+        self._snapshots[key] = encoded
+
+    async def _refresh(self, key, data):
+        try:
+            remote = await run_redis_command(self.redis_client, "hgetall", key)
+        except RedisUnavailableError:
+            return
+        snapshot = self._snapshots.get(key, {})
+        local = self._encode(data)
+        # Local changes not written yet win over what Redis holds
+        dirty = {f for f in local.keys() | snapshot.keys() if local.get(f) != snapshot.get(f)}
+        for field, value in remote.items():
+            if field not in dirty and local.get(field) != value:
+                data[field] = json.loads(value)
+        for field in snapshot:
+            if field not in remote and field not in dirty:
+                data.pop(field, None)
+        self._snapshots[key] = remote
+
+    # Users and chats are loaded lazily by the refresh_* hooks
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        data = BotData()
+        await self._refresh(self._key("bot"), data)
+        return data
+
+    async def get_callback_data(self):
         return None
 
+    async def get_conversations(self, name):
+        try:
+            raw = await run_redis_command(self.redis_client, "hgetall", self._key("conversation", name))
+        except RedisUnavailableError:
+            return {}
+        return {tuple(json.loads(k)): json.loads(v) for k, v in raw.items()}
+
+    async def update_conversation(self, name, key, new_state):
+        redis_key = self._key("conversation", name)
+        field = json.dumps(list(key))
+        try:
+            if new_state is None:
+                await run_redis_command(self.redis_client, "hdel", redis_key, field)
+            else:
+                await run_redis_command(self.redis_client, "hset", redis_key, field, json.dumps(new_state))
+        except RedisUnavailableError:
+            return
+
+    async def update_user_data(self, user_id, data):
+        await self._write(self._key("user", user_id), data)
+
+    async def update_chat_data(self, chat_id, data):
+        await self._write(self._key("chat", chat_id), data)
+
+    async def update_bot_data(self, data):
+        await self._write(self._key("bot"), data)
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def _drop(self, key):
+        self._snapshots.pop(key, None)
+        try:
+            await run_redis_command(self.redis_client, "delete", key)
+        except RedisUnavailableError:
+            return
+
+    async def drop_user_data(self, user_id):
+        await self._drop(self._key("user", user_id))
+
+    async def drop_chat_data(self, chat_id):
+        await self._drop(self._key("chat", chat_id))
+
+    async def refresh_user_data(self, user_id, user_data):
+        await self._refresh(self._key("user", user_id), user_data)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        await self._refresh(self._key("chat", chat_id), chat_data)
+
+    async def refresh_bot_data(self, bot_data):
+        # Called before every handler; bot-wide data changes rarely, so at
+        # most one read per update interval
+        now = time.monotonic()
+        if now - self._bot_data_refreshed_at < self.update_interval:
+            return
+        self._bot_data_refreshed_at = now
+        await self._refresh(self._key("bot"), bot_data)
+
+    async def flush(self):
+        pass
+
+# === CIRCUIT BREAKER ===
+class CircuitOpenError(Exception):
+    pass
+
+class OtaSourceError(Exception):
+    pass
+
+class CircuitBreaker:
+    """
+    Watches the outcome and latency of the last `window` calls to one
+    upstream. Opens when too many failed or were slow, rejects calls while
+    open, and after `cooldown` seconds lets a single probe decide whether to
+    close again. allow() hands out a ticket that the caller passes back to
+    record(), so calls that started before the trip cannot pose as the probe.
+    """
+
+    def __init__(
+        self, name, window=OTA_BREAKER_WINDOW, min_calls=OTA_BREAKER_MIN_CALLS,
+        error_rate=OTA_BREAKER_ERROR_RATE, slow_call=OTA_BREAKER_SLOW_CALL,
+        slow_rate=OTA_BREAKER_SLOW_RATE, cooldown=OTA_BREAKER_COOLDOWN
+    ):
+        self.name = name
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.slow_rate = slow_rate
+        self.cooldown = cooldown
+        self.state = "closed"
+        self._outcomes = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probe = None
+        self._probe_started = None
+
+    def allow(self):
+        """Returns a ticket for record(), or None when the call is rejected."""
+        if self.state == "closed":
+            return True
+        now = time.monotonic()
+        if self.state == "open":
+            if now - self._opened_at < self.cooldown:
+                return None
+            self.state = "half_open"
+        # One probe at a time; a probe that never reported back is replaced
+        if self._probe is not None and now - self._probe_started < self.cooldown:
+            return None
+        self._probe = object()
+        self._probe_started = now
+        return self._probe
+
+    def record(self, ticket, ok, latency):
+        slow = latency >= self.slow_call
+        if self.state == "half_open":
+            # Only the probe's own outcome decides
+            if ticket is not self._probe:
+                return
+            self._probe = None
+            if ok and not slow:
+                self._close()
+            else:
+                self._open("probe failed" if not ok else f"probe took {latency:.1f}s")
+            return
+        if self.state == "open":
+            return
+
+        self._outcomes.append((ok, slow))
+        if len(self._outcomes) < self.min_calls:
+            return
+        total = len(self._outcomes)
+        failed = sum(1 for ok, _ in self._outcomes if not ok)
+        slow_calls = sum(1 for _, slow in self._outcomes if slow)
+        if failed / total >= self.error_rate or slow_calls / total >= self.slow_rate:
+            self._open(f"{failed}/{total} failed, {slow_calls}/{total} slow")
+
+    def _open(self, reason):
+        self.state = "open"
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+        print(f"[WARNING] Circuit for {self.name} opened ({reason}); retrying in {self.cooldown:.0f}s.")
+
+    def _close(self):
+        self.state = "closed"
+        self._outcomes.clear()
+        print(f"Circuit for {self.name} closed.")
+
+# === OTA CACHE ===
+class OtaCache:
+    """
+    Two-tier cache for `{SETTINGS.base_url}/<codename>/updates.json`.
+
+    Entries live in an in-process LRU and in a Redis hash shared by every
+    replica. Once an entry is older than `ttl` it is revalidated with
+    If-None-Match / If-Modified-Since, and a 304 counts as a hit.
+    Concurrent lookups for the same codename share one upstream request.
+
+    Upstream calls go through a circuit breaker. When revalidation fails or
+    takes longer than `stale_grace`, the last good record is returned with
+    a `stale_since` timestamp and the fetch carries on in the background.
+    """
+
+    def __init__(
+        self, http_client, redis_client, ttl=OTA_CACHE_TTL, max_entries=OTA_CACHE_MAX_ENTRIES,
+        stale_grace=OTA_STALE_GRACE
+    ):
+        self.http_client = http_client
+        self.redis_client = redis_client
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stale_grace = stale_grace
+        self.breaker = CircuitBreaker("OTA source")
+        self._entries = OrderedDict()
+        self._inflight = {}
+        # Called with (codename, record) whenever a cached record is (re)loaded
+        # or dropped (record is None)
+        self.listeners = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def redis_key(device_codename):
+        return f"ota:cache:{device_codename}"
+
+    def _is_fresh(self, entry, max_age=None):
+        max_age = self.ttl if max_age is None else max_age
+        return time.time() - entry["checked_at"] < max_age
+
+    def _notify(self, device_codename, record):
+        for listener in self.listeners:
+            try:
+                listener(device_codename, record)
+            except Exception as e:
+                print(f"[ERROR] OTA cache listener failed for {device_codename}: {e}")
+
+    def _remember(self, device_codename, entry):
+        self._entries[device_codename] = entry
+        self._entries.move_to_end(device_codename)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self._notify(device_codename, entry["record"])
+
+    def _forget(self, device_codename):
+        if self._entries.pop(device_codename, None) is not None:
+            self._notify(device_codename, None)
+
+    async def get(self, device_codename, max_age=None, allow_stale=True):
+        """
+        Returns the parsed record, revalidating upstream when the cached
+        entry is older than `max_age` seconds (defaults to the cache TTL).
+        With `allow_stale`, an outage or slow upstream yields the last good
+        record marked with `stale_since` instead of an error.
+        """
+        entry = self._entries.get(device_codename)
+        if entry is not None:
+            self._entries.move_to_end(device_codename)
+            if self._is_fresh(entry, max_age):
+                METRICS.inc("ota_cache_lookups", result="hit")
+                return dict(entry["record"])
+
+        task = self._inflight.get(device_codename)
+        if task is None:
+            task = asyncio.ensure_future(self._load(device_codename, entry, max_age))
+            self._inflight[device_codename] = task
+            task.add_done_callback(lambda t: self._load_done(device_codename, t))
+        try:
+            # Shielded so a cancelled or timed-out waiter does not cancel the shared fetch
+            if entry is not None and allow_stale:
+                record, result = await asyncio.wait_for(asyncio.shield(task), self.stale_grace)
+            else:
+                record, result = await asyncio.shield(task)
+        except Exception:
+            entry = self._entries.get(device_codename)
+            if entry is None or not allow_stale:
+                METRICS.inc("ota_cache_lookups", result="error")
+                raise
+            METRICS.inc("ota_cache_lookups", result="stale")
+            return self._stale(entry)
+        METRICS.inc("ota_cache_lookups", result=result)
+        return dict(record) if record else None
+
+    def _load_done(self, device_codename, task):
+        self._inflight.pop(device_codename, None)
+        # Retrieve the error of fetches that outlived their waiters; callers
+        # log their own failures and the breaker reports outages
+        if not task.cancelled():
+            task.exception()
+
+    @staticmethod
+    def _stale(entry):
+        record = dict(entry["record"])
+        record["stale_since"] = entry["checked_at"]
+        return record
+
+    async def _fetch(self, url, headers):
+        ticket = self.breaker.allow()
+        if ticket is None:
+            raise CircuitOpenError(f"{self.breaker.name} is unavailable")
+        started = time.monotonic()
+        try:
+            with METRICS.timer("ota_http"):
+                res = await self.http_client.get(url, headers=headers)
+        except Exception:
+            self.breaker.record(ticket, False, time.monotonic() - started)
+            raise
+        METRICS.inc("ota_http_responses", status=res.status_code)
+        failed = res.status_code >= 500 or res.status_code == 429
+        self.breaker.record(ticket, not failed, time.monotonic() - started)
+        if failed:
+            raise OtaSourceError(f"{url} returned HTTP {res.status_code}")
+        return res
+
+    async def _load(self, device_codename, entry, max_age=None):
+        """Returns (record, how it was obtained) for the lookup metrics."""
+        if entry is None:
+            entry = await self._load_from_redis(device_codename)
+            if entry is not None:
+                self._remember(device_codename, entry)
+                if self._is_fresh(entry, max_age):
+                    return entry["record"], "redis_hit"
+
+        headers = {}
+        if entry is not None:
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        url = f"{SETTINGS.base_url}/{device_codename}/updates.json"
+        res = await self._fetch(url, headers)
+
+        if res.status_code == 304 and entry is not None:
+            entry["checked_at"] = time.time()
+            await self._store_in_redis(device_codename, {"checked_at": entry["checked_at"]})
+            return entry["record"], "revalidated"
+
+        # Anything but a server error means the file is really gone or unusable
+        if res.status_code != 200:
+            self._forget(device_codename)
+            return None, "gone"
+
+        record = parse_rom_data(device_codename, res.json())
+        if record is None:
+            self._forget(device_codename)
+            return None, "gone"
+
+        entry = {
+            "record": record,
+            "etag": res.headers.get("ETag", ""),
+            "last_modified": res.headers.get("Last-Modified", ""),
+            "checked_at": time.time(),
+        }
+        self._remember(device_codename, entry)
+        await self._store_in_redis(device_codename, {
+            "body": res.text,
+            "etag": entry["etag"],
+            "last_modified": entry["last_modified"],
+            "checked_at": entry["checked_at"],
+        })
+        return record, "miss"
+
+    async def warm(self, device_codenames):
+        """Loads the Redis tier for several codenames in one pipeline."""
+        missing = [c for c in device_codenames if c not in self._entries]
+        if not missing:
+            return
+        try:
+            results = await run_redis_pipeline(
+                self.redis_client,
+                lambda pipe: [pipe.hgetall(self.redis_key(c)) for c in missing]
+            )
+        except RedisUnavailableError:
+            return
+        for device_codename, cached in zip(missing, results):
+            entry = self._entry_from_redis(device_codename, cached)
+            if entry is not None:
+                self._remember(device_codename, entry)
+
+    async def _store_in_redis(self, device_codename, fields):
+        key = self.redis_key(device_codename)
+        try:
+            await run_redis_pipeline(
+                self.redis_client,
+                lambda pipe: (pipe.hset(key, mapping=fields), pipe.expire(key, OTA_CACHE_REDIS_TTL))
+            )
+        except RedisUnavailableError:
+            pass
+
+    async def _load_from_redis(self, device_codename):
+        try:
+            cached = await run_redis_command(self.redis_client, "hgetall", self.redis_key(device_codename))
+        except RedisUnavailableError:
+            return None
+        return self._entry_from_redis(device_codename, cached)
+
+    @staticmethod
+    def _entry_from_redis(device_codename, cached):
+        if not cached or "body" not in cached:
+            return None
+        try:
+            record = parse_rom_data(device_codename, json.loads(cached["body"]))
+        except ValueError:
+            return None
+        if record is None:
+            return None
+        return {
+            "record": record,
+            "etag": cached.get("etag", ""),
+            "last_modified": cached.get("last_modified", ""),
+            "checked_at": float(cached.get("checked_at", 0)),
+        }
+
 # === HELPERS ===
 def format_date(timestamp):
     return datetime.fromtimestamp(timestamp).strftime("%d %B %Y")
 
-def fetch_rom_data(device_codename):
-    url = f"{BASE_URL}/{device_codename}/updates.json"
+def parse_rom_data(device_codename, json_data):
+    if "response" in json_data and json_data["response"]:
+        j = json_data["response"][0]
+        return {
+            "device_codename": device_codename,
+            "device_name": j.get("device"),
+            "rom_name": "AfterlifeOS",
+            "version": j.get("version"),
+            "release_codename": j.get("codename"),
+            "download_url": j.get("download"),
+            "build_date": j.get("timestamp"),
+            "size": j.get("size"),
+            "build_type": j.get("buildtype"),
+            "maintainer_name": j.get("maintainer"),
+            "maintainer_link": j.get("telegram"),
+            "support_group": j.get("forum"),
+        }
+    return None
+
+async def fetch_rom_data(ota_cache, device_codename):
     try:
-        res = requests.get(url, timeout=10)
-        if res.status_code == 200:
-            json_data = res.json()
-            if "response" in json_data and json_data["response"]:
-                j = json_data["response"][0]
-                return {
-                    "device_codename": device_codename,
-                    "device_name": j.get("device"),
-                    "rom_name": "AfterlifeOS",
-                    "version": j.get("version"),
-                    "release_codename": j.get("codename"),
-                    "download_url": j.get("download"),
-                    "build_date": j.get("timestamp"),
-                    "size": j.get("size"),
-                    "build_type": j.get("buildtype"),
-                    "maintainer_name": j.get("maintainer"),
-                    "maintainer_link": j.get("telegram"),
-                    "support_group": j.get("forum"),
-                }
+        with METRICS.timer("fetch_rom_data"):
+            return await ota_cache.get(device_codename)
     except Exception as e:
         print(f"[ERROR] Failed to fetch JSON {device_codename}: {e}")
     return None
 
+async def fetch_rom_data_fresh(ota_cache, device_codename):
+    # Always revalidates upstream; an unchanged file costs a 304. An open
+    # circuit is raised so callers can report it once instead of per device.
+    try:
+        with METRICS.timer("fetch_rom_data", mode="fresh"):
+            return await ota_cache.get(device_codename, max_age=0, allow_stale=False)
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        print(f"[ERROR] Failed to fetch JSON {device_codename}: {e}")
+    return None
+
+async def fetch_device_list(http_client, etag=""):
+    """
+    Returns (codenames, etag) for the device directories in the OTA repo.
+    codenames is None when the tree is unchanged (304) or the fetch failed.
+    """
+    headers = {"Accept": "application/vnd.github+json"}
+    if etag:
+        headers["If-None-Match"] = etag
+    try:
+        res = await http_client.get(OTA_TREE_URL, headers=headers)
+        if res.status_code == 304:
+            return None, etag
+        if res.status_code == 200:
+            codenames = sorted(
+                entry["path"] for entry in res.json().get("tree", [])
+                if entry.get("type") == "tree" and not entry["path"].startswith(".")
+            )
+            return codenames, res.headers.get("ETag", "")
+        print(f"[ERROR] Failed to fetch device list: HTTP {res.status_code}")
+    except Exception as e:
+        print(f"[ERROR] Failed to fetch device list: {e}")
+    return None, etag
+
+async def fetch_many_rom_data(ota_cache, device_codenames, concurrency=BULK_FETCH_CONCURRENCY):
+    slots = asyncio.Semaphore(concurrency)
+    await ota_cache.warm(device_codenames)
+
+    async def fetch_one(device_codename):
+        async with slots:
+            return await fetch_rom_data(ota_cache, device_codename)
+
+    results = await asyncio.gather(*(fetch_one(c) for c in device_codenames))
+    return dict(zip(device_codenames, results))
+
+def stale_notice(data):
+    """Warning for records served from cache while the OTA source is down."""
+    stale_since = data.get("stale_since")
+    if not stale_since:
+        return ""
+    minutes = max(int((time.time() - stale_since) // 60), 1)
+    return f"⚠️ OTA source unreachable, using cached data from {minutes} min ago."
+
 def bytes_to_gb(size_bytes):
     if not isinstance(size_bytes, (int, float)) or size_bytes == 0:
         return "N/A"
     return f"{size_bytes / (1024 ** 3):.2f} GB"
 
-def format_post(data, posted_by_username, notes_list=None):
-    rom_name = data.get("rom_name", "AfterlifeOS")
-    version = data.get("version", "Unknown")
-    device_name = data.get("device_name", data['device_codename'])
-    maintainer_name = data.get("maintainer_name", posted_by_username)
-    maintainer_link = data.get("maintainer_link", f"https://t.me/{posted_by_username}")
-    build_date = format_date(int(data['build_date'])) if data.get("build_date") else "Unknown"
-    size = bytes_to_gb(data.get("size"))
-    release_type = data.get("build_type", "unofficial").capitalize()
-    device_codename = data['device_codename']
-    device_codename_tag = f"#{data['device_codename']}"
-    release_codename = data['release_codename'].capitalize() if data.get("release_codename") else ""
-    release_codename_tag = f"#{data['release_codename']}" if data.get("release_codename") else ""
-
-    post = (
-        f"<b>{rom_name} v{version} {release_codename} | {release_type} | Android 16</b>\n"
-        f"Supported Device: {device_name} - {device_codename}\n"
-        f"Build date: {build_date}\n"
-        f"Maintainer: <a href='{maintainer_link}'>{maintainer_name}</a>\n"
-    )
-
-    if notes_list:
-        notes_section = "\n".join([f"- {note.lstrip('- ')}" for note in notes_list if note.strip()])
-        if notes_section:
-            post += f"\n<b>Notes:</b>\n{notes_section}\n"
-
-    post += (
-        f"\nThere's nothing special about my rom, you can skip if you don't like, or you can taste it.\n"
-        f"Subscribe For More <a href='https://t.me/Afterlife_update'>AfterlifeOS</a>\n\n"
-        f"Hope you all have a happy life\n"
-        f"Thank you.\n"
-    )
+class PostTemplate:
+    """
+    A caption layout compiled once: the literal text is split out at
+    startup, so rendering only joins it with the record's (already escaped)
+    fields. `{notes}` expands to the notes block, or nothing without notes.
+    """
 
-    post += f"\n#{rom_name} {device_codename_tag} {release_codename_tag} #NeverDie"
-    return post
+    def __init__(self, name, layout, notes_header):
+        self.name = name
+        self.notes_header = notes_header
+        self._parts = [(literal, field) for literal, field, _, _ in string.Formatter().parse(layout)]
+        self.fields = {field for _, field in self._parts if field}
+
+    def render(self, fields, notes_list=None):
+        out = []
+        for literal, field in self._parts:
+            out.append(literal)
+            if field == "notes":
+                out.append(self._notes(notes_list))
+            elif field:
+                out.append(fields[field])
+        return "".join(out)
+
+    def _notes(self, notes_list):
+        # Notes are HTML already (see parse_notes)
+        lines = [f"- {note.lstrip('- ')}" for note in notes_list or () if note.strip()]
+        if not lines:
+            return ""
+        return f"\n<b>{self.notes_header}</b>\n" + "\n".join(lines) + "\n"
+
+POST_TEMPLATES = {
+    "default": PostTemplate("default", (
+        "<b>{rom_name} v{version} {release_name} | {release_type} | Android 16</b>\n"
+        "Supported Device: {device_name} - {device_codename}\n"
+        "Build date: {build_date}\n"
+        "Maintainer: <a href='{maintainer_link}'>{maintainer_name}</a>\n"
+        "{notes}"
+        "\nThere's nothing special about my rom, you can skip if you don't like, or you can taste it.\n"
+        "Subscribe For More <a href='https://t.me/Afterlife_update'>AfterlifeOS</a>\n\n"
+        "Hope you all have a happy life\n"
+        "Thank you.\n"
+        "\n#{rom_name} {device_tag} {release_tag} #NeverDie"
+    ), "Notes:"),
+    "id": PostTemplate("id", (
+        "<b>{rom_name} v{version} {release_name} | {release_type} | Android 16</b>\n"
+        "Perangkat: {device_name} - {device_codename}\n"
+        "Tanggal build: {build_date}\n"
+        "Maintainer: <a href='{maintainer_link}'>{maintainer_name}</a>\n"
+        "{notes}"
+        "\nTidak ada yang spesial dari rom saya, boleh dilewati kalau tidak suka, atau silakan dicoba.\n"
+        "Ikuti <a href='https://t.me/Afterlife_update'>AfterlifeOS</a> untuk update lainnya\n\n"
+        "Semoga kalian semua selalu bahagia\n"
+        "Terima kasih.\n"
+        "\n#{rom_name} {device_tag} {release_tag} #NeverDie"
+    ), "Catatan:"),
+}
+
+def parse_post_targets(spec, channel_id):
+    targets = []
+    for item in spec.split(","):
+        chat_id, _, template = item.strip().rpartition("=")
+        if not item.strip():
+            continue
+        if not chat_id:
+            chat_id, template = template, "default"
+        if template not in POST_TEMPLATES:
+            print(f"[WARNING] Unknown template '{template}' in POST_TARGETS, using 'default' for {chat_id}.")
+            template = "default"
+        targets.append((chat_id, template))
+    return targets or [(channel_id, "default")]
+
+@functools.lru_cache(maxsize=OTA_CACHE_MAX_ENTRIES)
+def _post_fields(items, posted_by_username):
+    data = dict(items)
+    device_codename = data['device_codename']
+    release_codename = data.get("release_codename") or ""
+    fields = {
+        "rom_name": data.get("rom_name", "AfterlifeOS"),
+        "version": data.get("version", "Unknown"),
+        "release_name": release_codename.capitalize(),
+        "release_type": (data.get("build_type") or "unofficial").capitalize(),
+        "device_name": data.get("device_name", device_codename),
+        "device_codename": device_codename,
+        "build_date": format_date(int(data['build_date'])) if data.get("build_date") else "Unknown",
+        "size": bytes_to_gb(data.get("size")),
+        "maintainer_name": data.get("maintainer_name", posted_by_username),
+        "maintainer_link": data.get("maintainer_link", f"https://t.me/{posted_by_username}"),
+        "device_tag": f"#{device_codename}",
+        "release_tag": f"#{release_codename}" if release_codename else "",
+    }
+    # Every field comes from the OTA json or the maintainer, so none of it is trusted HTML
+    return {name: html.escape(str(value)) for name, value in fields.items()}
+
+def post_fields(data, posted_by_username):
+    """Escaped template fields for a record, cached per record."""
+    return _post_fields(tuple(sorted(data.items())), posted_by_username)
+
+def format_post(data, posted_by_username, notes_list=None, template="default"):
+    return POST_TEMPLATES[template].render(post_fields(data, posted_by_username), notes_list)
+
+def render_post_targets(data, posted_by_username, notes_list=None):
+    """Renders one record for every POST_TARGETS entry: [(chat_id, caption), ...]."""
+    fields = post_fields(data, posted_by_username)
+    return [(chat_id, POST_TEMPLATES[template].render(fields, notes_list)) for chat_id, template in SETTINGS.post_targets]
+
+def describe_targets():
+    return ", ".join(str(chat_id) for chat_id, _ in SETTINGS.post_targets)
+
+async def send_post(bot, photo, posts, keyboard):
+    """
+    Sends rendered `posts` [(chat_id, caption), ...] through the bulk queue.
+    Returns ({chat_id: Message}, {chat_id: error}).
+    """
+    sent, errors = {}, {}
+    for chat_id, caption in posts:
+        try:
+            sent[chat_id] = await bot.send_photo(
+                chat_id=chat_id,
+                photo=photo,
+                caption=caption,
+                parse_mode=ParseMode.HTML,
+                reply_markup=keyboard,
+                rate_limit_args={"priority": PRIORITY_BULK}
+            )
+        except Exception as e:
+            print(f"[ERROR] Failed to post to {chat_id}: {e}")
+            errors[chat_id] = e
+    return sent, errors
 
-def build_keyboard(data):
-    codename = data['device_codename']
-    mt_support = data.get("support_group") or AFL_SUPPORT
+@functools.lru_cache(maxsize=OTA_CACHE_MAX_ENTRIES)
+def _device_keyboard(codename, mt_support):
+    # InlineKeyboardMarkup is immutable, so one instance per device is shared
     buttons = [
         [
             InlineKeyboardButton("Download", url=f"https://afterlifeos.com/device/{codename}/"),
@@ -168,18 +1410,1276 @@ def build_keyboard(data):
     ]
     return InlineKeyboardMarkup(buttons)
 
-def confirm_keyboard(device_codename, poster_username, user_id):
+def build_keyboard(data):
+    return _device_keyboard(data['device_codename'], data.get("support_group") or AFL_SUPPORT)
+
+def confirm_keyboard(draft_id, editable=False):
+    rows = [
+        [
+            InlineKeyboardButton("✅ Post to Channel", callback_data=f"confirm_send:{draft_id}"),
+            InlineKeyboardButton("🕒 Schedule", callback_data=f"schedule:{draft_id}")
+        ],
+        [InlineKeyboardButton("❌ Cancel", callback_data=f"cancel_post:{draft_id}")]
+    ]
+    if editable:
+        rows.insert(1, [InlineKeyboardButton("✏️ Update last post instead", callback_data=f"edit_post:{draft_id}")])
+    return InlineKeyboardMarkup(rows)
+
+def ask_notes_keyboard(draft_id):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("Yes, add notes", callback_data=f"notes_yes:{draft_id}")],
+        [InlineKeyboardButton("No, continue", callback_data=f"notes_no:{draft_id}")]
+    ])
+
+def parse_notes(notes_raw):
+    # Escape first so only the [text](url) links become markup
+    notes_with_html_links = re.sub(r'\[(.*?)\]\((.*?)\)', r'<a href="\2">\1</a>', html.escape(notes_raw))
+    return [line.strip() for line in notes_with_html_links.split("\n") if line.strip()]
+
+# === RUNTIME SETTINGS ===
+# Access lists, post targets and the OTA source come from the environment and
+# can be overridden per name in the SETTINGS_KEY hash. A reload swaps in a new
+# immutable Settings, so a handler always sees one consistent snapshot and the
+# access checks are frozenset lookups. Replicas reload on SIGHUP (which also
+# rereads private.env) and on every message on SETTINGS_CHANNEL, which /config
+# publishes after changing an override.
+SETTINGS_KEY = "settings"
+SETTINGS_CHANNEL = "settings:reload"
+SETTINGS_DEFAULTS = {
+    "ALLOWED_CHAT_IDS": "",
+    "ADMIN_USER_IDS": "",
+    "CHANNEL_ID": "",
+    # Where confirmed posts go: "chat=template,chat=template" (defaults to CHANNEL_ID=default)
+    "POST_TARGETS": "",
+    # Review chat for the OTA watcher (defaults to the first allowed chat)
+    "OTA_WATCH_CHAT_ID": "",
+    "BASE_URL": "https://raw.githubusercontent.com/AfterlifeOS/device_afterlife_ota/refs/heads/16",
+}
+
+def parse_id_list(raw):
+    """Returns (ids in order, invalid items) for a comma separated list."""
+    ids, invalid = [], []
+    for item in raw.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            ids.append(int(item))
+        except ValueError:
+            invalid.append(item)
+    return ids, invalid
+
+class Settings:
+    """One snapshot of the reloadable settings; never mutated after loading."""
+
+    def __init__(self, values, sources):
+        self.values = values
+        self.sources = sources
+        allowed_chat_ids, invalid = parse_id_list(values["ALLOWED_CHAT_IDS"])
+        for item in invalid:
+            print(f"[WARNING] Ignoring invalid ID in ALLOWED_CHAT_IDS: {item}")
+        admin_user_ids, invalid = parse_id_list(values["ADMIN_USER_IDS"])
+        for item in invalid:
+            print(f"[WARNING] Ignoring invalid ID in ADMIN_USER_IDS: {item}")
+        self.allowed_chat_ids = frozenset(allowed_chat_ids)
+        self.admin_user_ids = frozenset(admin_user_ids)
+        self.channel_id = values["CHANNEL_ID"] or None
+        self.post_targets = tuple(parse_post_targets(values["POST_TARGETS"], self.channel_id))
+        self.review_chat_id = values["OTA_WATCH_CHAT_ID"] or (allowed_chat_ids[0] if allowed_chat_ids else None)
+        self.base_url = values["BASE_URL"].rstrip("/")
+
+    @classmethod
+    def load(cls, overrides=None):
+        """Reads the environment; `overrides` (the Redis hash) take precedence."""
+        overrides = overrides or {}
+        values, sources = {}, {}
+        for name, default in SETTINGS_DEFAULTS.items():
+            if name in overrides:
+                values[name], sources[name] = overrides[name], "redis"
+            elif os.environ.get(name):
+                values[name], sources[name] = os.environ[name], "env"
+            else:
+                values[name], sources[name] = default, "default"
+        return cls(values, sources)
+
+def apply_settings(settings, announce=False):
+    """Swaps in `settings`; they are printed when they changed or `announce` is set."""
+    global SETTINGS
+    previous, SETTINGS = SETTINGS, settings
+    if not announce and previous.values == settings.values:
+        return
+    print(
+        f"Settings loaded: {len(settings.allowed_chat_ids)} Chat IDs {sorted(settings.allowed_chat_ids)}, "
+        f"{len(settings.admin_user_ids)} Admin IDs {sorted(settings.admin_user_ids)}, posting to {describe_targets()}."
+    )
+    if not settings.admin_user_ids:
+        print("[WARNING] ADMIN_USER_IDS is not set. Banner commands will not be usable by anyone.")
+
+# Environment only until SettingsStore.load() adds the Redis overrides
+SETTINGS = Settings.load()
+
+class SettingsStore:
+    """Keeps SETTINGS in sync with private.env and the overrides in Redis."""
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.loaded = False
+        self.overrides = {}
+
+    async def load(self):
+        overrides = await run_redis_command(self.redis_client, "hgetall", SETTINGS_KEY)
+        self.overrides = {name: value for name, value in overrides.items() if name in SETTINGS_DEFAULTS}
+        apply_settings(Settings.load(self.overrides), announce=not self.loaded)
+        self.loaded = True
+        return len(self.overrides)
+
+    def without(self, name):
+        """The settings that would apply if the override for `name` were removed."""
+        return Settings.load({n: v for n, v in self.overrides.items() if n != name})
+
+    async def reload(self, reread_env=False):
+        if reread_env:
+            load_dotenv(dotenv_path='private.env', override=True)
+        try:
+            await self.load()
+        except RedisUnavailableError:
+            print("[WARNING] Redis is unavailable; reloading settings with the last known overrides.")
+            apply_settings(Settings.load(self.overrides))
+
+    async def set(self, name, value):
+        """Stores an override (None removes it) and tells every replica to reload."""
+        def build(pipe):
+            if value is None:
+                pipe.hdel(SETTINGS_KEY, name)
+            else:
+                pipe.hset(SETTINGS_KEY, name, value)
+            pipe.publish(SETTINGS_CHANNEL, name)
+        await run_redis_pipeline(self.redis_client, build, transaction=True)
+        overrides = {n: v for n, v in self.overrides.items() if n != name}
+        if value is not None:
+            overrides[name] = value
+        self.overrides = overrides
+        apply_settings(Settings.load(overrides))
+
+    async def listen(self):
+        """Reloads on every message on SETTINGS_CHANNEL until cancelled."""
+        while True:
+            try:
+                async with self.redis_client.pubsub(ignore_subscribe_messages=True) as pubsub:
+                    await pubsub.subscribe(SETTINGS_CHANNEL)
+                    await self.load()
+                    async for message in pubsub.listen():
+                        await self.reload(reread_env=message["data"] == "reload")
+            except (RedisError, RedisUnavailableError, OSError) as e:
+                print(f"[WARNING] Settings listener disconnected: {e}")
+                await asyncio.sleep(5)
+
+# === DRAFTS ===
+# A draft holds the fetched ROM record and the notes for one pending post,
+# so callbacks only carry the short draft id and confirming needs no refetch.
+def draft_key(draft_id):
+    return f"draft:{draft_id}"
+
+async def create_draft(redis_client, data, poster_username, user_id, notes_list=None):
+    draft = {
+        "id": secrets.token_urlsafe(8),
+        "data": data,
+        "notes": notes_list or [],
+        "poster_username": poster_username,
+        "user_id": user_id,
+    }
+    await save_draft(redis_client, draft)
+    return draft
+
+async def save_draft(redis_client, draft):
+    await run_redis_command(redis_client, "set", draft_key(draft["id"]), json.dumps(draft), ex=DRAFT_TTL)
+
+async def save_drafts(redis_client, drafts):
+    await run_redis_pipeline(
+        redis_client,
+        lambda pipe: [pipe.set(draft_key(d["id"]), json.dumps(d), ex=DRAFT_TTL) for d in drafts]
+    )
+
+async def load_draft(redis_client, draft_id):
+    raw = await run_redis_command(redis_client, "get", draft_key(draft_id))
+    return json.loads(raw) if raw else None
+
+async def claim_draft(redis_client, draft_id):
+    """Takes the draft out of Redis in one step; None if it was already used."""
+    raw = await run_redis_command(redis_client, "getdel", draft_key(draft_id))
+    return json.loads(raw) if raw else None
+
+async def delete_draft(redis_client, draft_id):
+    await run_redis_command(redis_client, "delete", draft_key(draft_id))
+
+def can_act_on_draft(draft, user):
+    # Drafts created by the OTA watcher have no owner; admins and the
+    # device maintainer (matched by Telegram username) may act on them
+    if draft["user_id"] is not None:
+        return user.id == draft["user_id"]
+    if user.id in SETTINGS.admin_user_ids:
+        return True
+    maintainer_link = draft["data"].get("maintainer_link") or ""
+    return bool(user.username) and maintainer_link.rstrip("/").lower().endswith(f"/{user.username.lower()}")
+
+# === POST HISTORY ===
+# Every published post is recorded with the message id it got in each target
+# chat. Entries live in one hash per device keyed by post id; a sorted set per
+# device and one across all devices order the ids by publish time, so
+# "/history surya" and "/latest" are ZREVRANGE + HMGET. A respin of an already
+# posted release can then update the existing messages instead of reposting.
+HISTORY_LATEST_KEY = "history:latest"
+
+def history_posts_key(codename):
+    return f"history:posts:{codename}"
+
+def history_order_key(codename):
+    return f"history:order:{codename}"
+
+# KEYS: device posts, device order, latest; ARGV: post id, time, entry, keep, codename.
+# Trims the device to its newest `keep` posts in the same step.
+HISTORY_RECORD_SCRIPT = """
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[3])
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+redis.call('ZADD', KEYS[3], ARGV[2], ARGV[5] .. ':' .. ARGV[1])
+local excess = redis.call('ZCARD', KEYS[2]) - tonumber(ARGV[4])
+if excess > 0 then
+    local old = redis.call('ZRANGE', KEYS[2], 0, excess - 1)
+    for _, id in ipairs(old) do
+        redis.call('ZREM', KEYS[2], id)
+        redis.call('HDEL', KEYS[1], id)
+        redis.call('ZREM', KEYS[3], ARGV[5] .. ':' .. id)
+    end
+end
+return 1
+"""
+
+def message_link(chat_id, message_id):
+    chat_id = str(chat_id)
+    if chat_id.startswith("@"):
+        return f"https://t.me/{chat_id[1:]}/{message_id}"
+    if chat_id.startswith("-100"):
+        return f"https://t.me/c/{chat_id[4:]}/{message_id}"
+    return None
+
+def can_edit_in_place(entry, data):
+    """True when `data` is a respin of the posted release (same version and release)."""
+    posted = entry["data"]
+    return all(posted.get(k) == data.get(k) for k in ("version", "release_codename", "build_type"))
+
+def format_history_entry(entry, with_codename=False):
+    fields = post_fields(entry["data"], entry["poster_username"])
+    line = f"• v{fields['version']} {fields['release_name']}"
+    if with_codename:
+        line = f"• <code>{fields['device_codename']}</code> " + line[2:]
+    line += f" — {format_date(entry['posted_at'])}"
+    # Older drafts could carry a null poster when the record had no maintainer
+    if entry["poster_username"]:
+        line += f", by {html.escape(entry['poster_username'])}"
+    links = [
+        f'<a href="{url}">{"post" if len(entry["messages"]) == 1 else html.escape(chat_id)}</a>'
+        for chat_id, message_id in entry["messages"].items()
+        if (url := message_link(chat_id, message_id))
+    ]
+    if links:
+        line += " — " + ", ".join(links)
+    if entry.get("edited_at"):
+        line += f" (edited {format_date(entry['edited_at'])})"
+    return line
+
+class PostHistory:
+    """Published posts per device and across all devices, newest first."""
+
+    def __init__(self, redis_client, keep=HISTORY_PER_DEVICE):
+        self.redis_client = redis_client
+        self.keep = keep
+        self._record_script = redis_client.register_script(HISTORY_RECORD_SCRIPT)
+
+    async def record(self, data, poster_username, notes, photo, sent):
+        """Stores a post that went out; `sent` maps chat id to the sent Message."""
+        codename = data["device_codename"]
+        entry = {
+            "id": secrets.token_urlsafe(8),
+            "posted_at": time.time(),
+            "data": {k: v for k, v in data.items() if k != "stale_since"},
+            "poster_username": poster_username,
+            "notes": notes,
+            "photo": photo,
+            "messages": {str(chat_id): message.message_id for chat_id, message in sent.items()},
+        }
+        await run_redis_script(
+            self._record_script,
+            keys=(history_posts_key(codename), history_order_key(codename), HISTORY_LATEST_KEY),
+            args=(entry["id"], entry["posted_at"], json.dumps(entry), self.keep, codename)
+        )
+        return entry
+
+    async def save(self, entry):
+        codename = entry["data"]["device_codename"]
+        await run_redis_command(self.redis_client, "hset", history_posts_key(codename), entry["id"], json.dumps(entry))
+
+    async def for_device(self, codename, limit=HISTORY_LIST_LIMIT):
+        ids = await run_redis_command(self.redis_client, "zrevrange", history_order_key(codename), 0, limit - 1)
+        if not ids:
+            return []
+        raw_entries = await run_redis_command(self.redis_client, "hmget", history_posts_key(codename), ids)
+        return [json.loads(raw) for raw in raw_entries if raw]
+
+    async def latest_for(self, codename):
+        entries = await self.for_device(codename, 1)
+        return entries[0] if entries else None
+
+    async def latest(self, limit=HISTORY_LIST_LIMIT):
+        members = await run_redis_command(self.redis_client, "zrevrange", HISTORY_LATEST_KEY, 0, limit - 1)
+        refs = [member.partition(":")[::2] for member in members]
+        raw_entries = await run_redis_pipeline(
+            self.redis_client,
+            lambda pipe: [pipe.hget(history_posts_key(codename), post_id) for codename, post_id in refs]
+        )
+        return [json.loads(raw) for raw in raw_entries if raw]
+
+async def record_post(history, draft, photo, sent):
+    # History is best effort; the post itself already went out
+    if not sent:
+        return
+    try:
+        await history.record(draft["data"], draft["poster_username"], draft["notes"], photo, sent)
+    except RedisUnavailableError:
+        print(f"[WARNING] Could not record post history for {draft['data']['device_codename']}.")
+
+async def edit_published_post(bot, entry, data, poster_username, notes):
+    """
+    Re-renders a recorded post with a respun build and edits its caption and
+    keyboard in every chat it went to. Returns (edited chat ids, unchanged
+    chat ids, {chat_id: error}).
+    """
+    templates = dict(SETTINGS.post_targets)
+    keyboard = build_keyboard(data)
+    edited, unchanged, errors = [], [], {}
+    for chat_id, message_id in entry["messages"].items():
+        try:
+            await bot.edit_message_caption(
+                chat_id=chat_id,
+                message_id=message_id,
+                caption=format_post(data, poster_username, notes, templates.get(chat_id, "default")),
+                parse_mode=ParseMode.HTML,
+                reply_markup=keyboard,
+                rate_limit_args={"priority": PRIORITY_BULK}
+            )
+            edited.append(chat_id)
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                unchanged.append(chat_id)
+            else:
+                errors[chat_id] = e
+        except Exception as e:
+            print(f"[ERROR] Failed to edit post {message_id} in {chat_id}: {e}")
+            errors[chat_id] = e
+    return edited, unchanged, errors
+
+async def review_keyboard(history, draft):
+    """confirm_keyboard, offering an in-place update when this release was already posted."""
+    try:
+        entry = await history.latest_for(draft["data"]["device_codename"])
+    except RedisUnavailableError:
+        entry = None
+    return confirm_keyboard(draft["id"], editable=bool(entry) and can_edit_in_place(entry, draft["data"]))
+
+# === DEVICE INDEX ===
+class DeviceEntry:
+    __slots__ = ("codename", "device_name", "maintainer")
+
+    def __init__(self, codename, device_name=None, maintainer=None):
+        self.codename = codename
+        self.device_name = device_name
+        self.maintainer = maintainer
+
+    def dump(self):
+        return json.dumps([self.device_name, self.maintainer])
+
+class DeviceIndex:
+    """
+    In-memory index of every device in the OTA repository, persisted to a
+    Redis hash. Resolves codenames for /post without a network round trip
+    and answers lookups by maintainer. A device added since the last refresh
+    is still fetched on a miss and learned from its record.
+    """
+
+    REDIS_KEY = "device_index"
+
+    def __init__(self):
+        self._entries = {}
+        self._lower = {}
+        self._by_maintainer = {}
+        self.tree_etag = ""
+
+    def __len__(self):
+        return len(self._entries)
+
+    def codenames(self):
+        return sorted(self._entries)
+
+    def get(self, codename):
+        return self._entries.get(codename)
+
+    def resolve(self, codename):
+        """Returns the canonical codename (case-insensitive) or None."""
+        return self._lower.get(codename.lower())
+
+    def suggest(self, codename, limit=3):
+        import difflib  # only needed for typos, kept off the startup path
+        matches = difflib.get_close_matches(codename.lower(), self._lower, n=limit, cutoff=0.6)
+        return [self._lower[m] for m in matches]
+
+    def by_maintainer(self, name):
+        return [self._entries[c] for c in sorted(self._by_maintainer.get(name.lower(), ()))]
+
+    def _put(self, entry):
+        self._drop(entry.codename)
+        self._entries[entry.codename] = entry
+        self._lower[entry.codename.lower()] = entry.codename
+        if entry.maintainer:
+            self._by_maintainer.setdefault(entry.maintainer.lower(), set()).add(entry.codename)
+
+    def _drop(self, codename):
+        entry = self._entries.pop(codename, None)
+        if entry is None:
+            return
+        self._lower.pop(codename.lower(), None)
+        if entry.maintainer:
+            codenames = self._by_maintainer.get(entry.maintainer.lower())
+            if codenames:
+                codenames.discard(codename)
+                if not codenames:
+                    del self._by_maintainer[entry.maintainer.lower()]
+
+    def update(self, codename, data=None):
+        """Upserts a device from a parsed ROM record; returns True if it changed."""
+        device_name = data.get("device_name") if data else None
+        maintainer = data.get("maintainer_name") if data else None
+        current = self._entries.get(codename)
+        if current is not None:
+            if data is None or (current.device_name, current.maintainer) == (device_name, maintainer):
+                return False
+        self._put(DeviceEntry(codename, device_name, maintainer))
+        return True
+
+    async def learn(self, redis_client, records):
+        """Adds devices found upstream but not yet in the index."""
+        added = [c for c, data in records.items() if data and c not in self._entries and self.update(c, data)]
+        try:
+            await self.persist(redis_client, added)
+        except RedisUnavailableError:
+            pass
+        return added
+
+    async def load(self, redis_client):
+        raw = await run_redis_command(redis_client, "hgetall", self.REDIS_KEY)
+        for codename, value in raw.items():
+            try:
+                device_name, maintainer = json.loads(value)
+            except ValueError:
+                continue
+            self._put(DeviceEntry(codename, device_name, maintainer))
+        return len(self._entries)
+
+    async def persist(self, redis_client, changed=(), removed=()):
+        changed = {c: self._entries[c].dump() for c in changed if c in self._entries}
+        removed = list(removed)
+        if not changed and not removed:
+            return
+
+        def build(pipe):
+            if changed:
+                pipe.hset(self.REDIS_KEY, mapping=changed)
+            if removed:
+                pipe.hdel(self.REDIS_KEY, *removed)
+
+        await run_redis_pipeline(redis_client, build)
+
+    async def refresh(self, http_client, ota_cache, redis_client):
+        """
+        Re-reads the repository tree (conditional, so an unchanged tree costs
+        a 304) and fetches records only for devices that were added.
+        """
+        codenames, self.tree_etag = await fetch_device_list(http_client, self.tree_etag)
+        if codenames is None:
+            return False
+        listed = set(codenames)
+        removed = [c for c in self._entries if c not in listed]
+        added = [c for c in codenames if c not in self._entries]
+        for codename in removed:
+            self._drop(codename)
+        records = await fetch_many_rom_data(ota_cache, added) if added else {}
+        for codename in added:
+            self.update(codename, records.get(codename))
+        try:
+            await self.persist(redis_client, added, removed)
+        except RedisUnavailableError:
+            pass
+        if added or removed:
+            print(f"Device index: {len(self._entries)} devices ({len(added)} added, {len(removed)} removed).")
+        return True
+
+async def device_index_job(context: ContextTypes.DEFAULT_TYPE):
+    await context.bot_data["device_index"].refresh(
+        context.bot_data["http"], context.bot_data["ota_cache"], context.bot_data["redis"]
+    )
+
+# === BANNERS ===
+# All banners live in one hash: "default", "device:<codename>" and
+# "release:<release codename>". Every replica keeps a copy in memory and
+# reloads it when a change is announced on BANNER_CHANNEL.
+BANNERS_KEY = "banners"
+BANNER_CHANNEL = "banners:invalidate"
+LEGACY_BANNER_KEY = "banner_file_id"
+BANNER_SCOPES = ("device", "release")
+
+def banner_field(scope=None, name=None):
+    if not scope:
+        return "default"
+    return f"{scope}:{name.lower()}"
+
+def parse_banner_scope(args):
+    """Returns the hash field for `[device <codename> | release <name>]`, or None if malformed."""
+    if not args:
+        return banner_field()
+    if len(args) == 2 and args[0].lower() in BANNER_SCOPES:
+        return banner_field(args[0].lower(), args[1])
+    return None
+
+def describe_banner_field(field):
+    scope, _, name = field.partition(":")
+    return f"{scope} <code>{html.escape(name)}</code>" if name else "default"
+
+class BannerCache:
+    """
+    In-process copy of the banner hash. Lookups never touch Redis; /setbanner
+    and /removebanner publish on BANNER_CHANNEL so every replica reloads.
+    """
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.loaded = False
+        self._banners = {}
+        # Called with no arguments after the banners changed
+        self.listeners = []
+
+    def __bool__(self):
+        return bool(self._banners)
+
+    def get(self, field):
+        return self._banners.get(field)
+
+    def fields(self):
+        return sorted(self._banners)
+
+    def resolve(self, device_codename=None, release_codename=None):
+        # The most specific banner wins: device, then release, then default
+        for scope, name in (("device", device_codename), ("release", release_codename)):
+            if name:
+                file_id = self._banners.get(banner_field(scope, name))
+                if file_id:
+                    return file_id
+        return self._banners.get(banner_field())
+
+    def for_record(self, data):
+        return self.resolve(data.get("device_codename"), data.get("release_codename"))
+
+    def _apply(self, banners):
+        if banners == self._banners:
+            return
+        self._banners = banners
+        for listener in self.listeners:
+            try:
+                listener()
+            except Exception as e:
+                print(f"[ERROR] Banner listener failed: {e}")
+
+    async def load(self):
+        banners, legacy = await run_redis_pipeline(
+            self.redis_client,
+            lambda pipe: (pipe.hgetall(BANNERS_KEY), pipe.get(LEGACY_BANNER_KEY))
+        )
+        if legacy:
+            # Move the old single-key banner into the hash once
+            await run_redis_pipeline(
+                self.redis_client,
+                lambda pipe: (pipe.hsetnx(BANNERS_KEY, banner_field(), legacy), pipe.delete(LEGACY_BANNER_KEY)),
+                transaction=True
+            )
+            banners.setdefault(banner_field(), legacy)
+        self.loaded = True
+        self._apply(banners)
+        return len(banners)
+
+    async def set(self, field, file_id):
+        await run_redis_pipeline(
+            self.redis_client,
+            lambda pipe: (pipe.hset(BANNERS_KEY, field, file_id), pipe.publish(BANNER_CHANNEL, field))
+        )
+        self._apply({**self._banners, field: file_id})
+
+    async def remove(self, field):
+        removed, _ = await run_redis_pipeline(
+            self.redis_client,
+            lambda pipe: (pipe.hdel(BANNERS_KEY, field), pipe.publish(BANNER_CHANNEL, field))
+        )
+        self._apply({f: v for f, v in self._banners.items() if f != field})
+        return bool(removed)
+
+    async def listen(self):
+        """Reloads on every invalidation message until cancelled."""
+        while True:
+            try:
+                async with self.redis_client.pubsub(ignore_subscribe_messages=True) as pubsub:
+                    await pubsub.subscribe(BANNER_CHANNEL)
+                    # Anything published while unsubscribed was missed
+                    await self.load()
+                    async for _ in pubsub.listen():
+                        await self.load()
+            except (RedisError, RedisUnavailableError, OSError) as e:
+                print(f"[WARNING] Banner invalidation listener disconnected: {e}")
+                await asyncio.sleep(5)
+
+# === INLINE PREVIEWS ===
+class PreviewCache:
+    """
+    Ready-rendered inline query results per codename, kept in sync with the
+    OTA cache through its listener hook. Inline queries are answered from
+    memory only: a sorted list of (lowercase codename, codename) pairs is
+    bisected for the lowercased prefix, so matching ignores case.
+    """
+
+    def __init__(self, banner_cache=None):
+        self.banner_cache = banner_cache
+        self._records = {}
+        self._results = {}
+        self._keys = []
+
+    def __len__(self):
+        return len(self._results)
+
+    def on_record(self, device_codename, record):
+        if record is None:
+            if self._results.pop(device_codename, None) is not None:
+                del self._records[device_codename]
+                self._keys.remove((device_codename.lower(), device_codename))
+            return
+        if self._records.get(device_codename) == record:
+            return
+        if device_codename not in self._results:
+            bisect.insort(self._keys, (device_codename.lower(), device_codename))
+        self._records[device_codename] = record
+        self._results[device_codename] = self._render(device_codename, record)
+
+    def on_banners(self):
+        for device_codename, record in self._records.items():
+            self._results[device_codename] = self._render(device_codename, record)
+
+    def _render(self, device_codename, record):
+        poster_username = record.get("maintainer_name") or device_codename
+        caption = format_post(record, poster_username)
+        keyboard = build_keyboard(record)
+        title = f"{record.get('device_name') or device_codename} ({device_codename})"
+        description = f"v{record.get('version')} · {record.get('maintainer_name') or 'Unknown'}"
+        banner_file_id = self.banner_cache.for_record(record) if self.banner_cache else None
+        if banner_file_id:
+            return InlineQueryResultCachedPhoto(
+                id=device_codename,
+                photo_file_id=banner_file_id,
+                title=title,
+                description=description,
+                caption=caption,
+                parse_mode=ParseMode.HTML,
+                reply_markup=keyboard,
+            )
+        return InlineQueryResultArticle(
+            id=device_codename,
+            title=title,
+            description=description,
+            input_message_content=InputTextMessageContent(caption, parse_mode=ParseMode.HTML),
+            reply_markup=keyboard,
+        )
+
+    def search(self, prefix, limit=INLINE_RESULTS_LIMIT):
+        prefix = prefix.lower()
+        results = []
+        start = bisect.bisect_left(self._keys, (prefix,))
+        for key, device_codename in itertools.islice(self._keys, start, None):
+            if not key.startswith(prefix) or len(results) >= limit:
+                break
+            results.append(self._results[device_codename])
+        return results
+
+# === OTA WATCHER ===
+# Polls every device on a schedule. Unchanged devices cost one conditional
+# request answered with 304; a build whose timestamp/version differs from the
+# last one seen gets a preview draft posted for approval.
+OTA_LAST_SEEN_KEY = "ota:last_seen"
+OTA_WATCH_LOCK_KEY = "ota:watch:lock"
+
+def build_stamp(data):
+    return f"{data.get('build_date')}:{data.get('version')}"
+
+async def ota_watch_job(context: ContextTypes.DEFAULT_TYPE):
+    redis_client: redis.Redis = context.bot_data["redis"]
+    ota_cache: OtaCache = context.bot_data["ota_cache"]
+
+    try:
+        # Only one replica polls per interval
+        acquired = await run_redis_command(
+            redis_client, "set", OTA_WATCH_LOCK_KEY, "1", nx=True, ex=max(OTA_WATCH_INTERVAL - 1, 1)
+        )
+        if not acquired:
+            return
+        last_seen = await run_redis_command(redis_client, "hgetall", OTA_LAST_SEEN_KEY)
+    except RedisUnavailableError:
+        return
+
+    device_index: DeviceIndex = context.bot_data["device_index"]
+    if not len(device_index):
+        await device_index.refresh(context.bot_data["http"], ota_cache, redis_client)
+    device_codenames = device_index.codenames()
+    if not device_codenames:
+        return
+
+    slots = asyncio.Semaphore(BULK_FETCH_CONCURRENCY)
+    skipped = 0
+
+    async def revalidate(device_codename):
+        nonlocal skipped
+        async with slots:
+            try:
+                return await fetch_rom_data_fresh(ota_cache, device_codename)
+            except CircuitOpenError:
+                skipped += 1
+                return None
+
+    results = await asyncio.gather(*(revalidate(c) for c in device_codenames))
+    if skipped:
+        print(f"[WARNING] OTA watcher skipped {skipped} devices: the OTA source circuit is open.")
+
+    # The very first pass only records what is already out; devices added
+    # later get their first build announced like any other
+    seeding = not last_seen
+    changed = {}
+    new_builds = []
+    index_changed = []
+    for device_codename, data in zip(device_codenames, results):
+        if not data:
+            continue
+        if device_index.update(device_codename, data):
+            index_changed.append(device_codename)
+        stamp = build_stamp(data)
+        if last_seen.get(device_codename) == stamp:
+            continue
+        if seeding:
+            changed[device_codename] = stamp
+        else:
+            new_builds.append((device_codename, data, stamp))
+
+    chat_id = SETTINGS.review_chat_id
+    if new_builds and not chat_id:
+        print("[WARNING] OTA watcher found new builds but the review chat is not set.")
+        new_builds = []
+
+    banner_cache: BannerCache = context.bot_data["banner_cache"]
+    for device_codename, data, stamp in new_builds:
+        banner_file_id = banner_cache.for_record(data)
+        if not banner_file_id:
+            print(f"[WARNING] OTA watcher found a new build for {device_codename} but no banner applies.")
+            continue
+        poster_username = data.get("maintainer_name") or device_codename
+        try:
+            draft = await create_draft(redis_client, data, poster_username, None)
+            caption = format_post(data, poster_username)
+            if len(caption) + 24 <= CAPTION_LIMIT:
+                caption = f"🆕 New build detected\n\n{caption}"
+            await context.bot.send_photo(
+                chat_id=chat_id,
+                photo=banner_file_id,
+                caption=caption,
+                parse_mode=ParseMode.HTML,
+                reply_markup=ask_notes_keyboard(draft["id"])
+            )
+            changed[device_codename] = stamp
+        except Exception as e:
+            print(f"[ERROR] OTA watcher failed to post preview for {device_codename}: {e}")
+
+    try:
+        await device_index.persist(redis_client, index_changed)
+        if changed:
+            await run_redis_command(redis_client, "hset", OTA_LAST_SEEN_KEY, mapping=changed)
+    except RedisUnavailableError:
+        pass
+    if changed:
+        print(f"OTA watcher: {len(new_builds)} new builds, {len(changed)} devices updated.")
+
+# === BULK RELEASES ===
+# A batch groups one draft per device; an admin approves the whole batch,
+# which is then posted in order through the bulk send queue.
+def batch_key(batch_id):
+    return f"batch:{batch_id}"
+
+def batch_keyboard(batch_id, ready_count):
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton("✅ Post to Channel", callback_data=f"confirm_send:{device_codename}:{poster_username}:{user_id}")],
-        [InlineKeyboardButton("❌ Cancel", callback_data=f"cancel_post:{user_id}")]
+        [InlineKeyboardButton(f"✅ Post {ready_count} to Channel", callback_data=f"batch_send:{batch_id}")],
+        [InlineKeyboardButton("❌ Cancel", callback_data=f"batch_cancel:{batch_id}")]
     ])
 
-def ask_notes_keyboard(device_codename, poster_username, user_id):
+def format_batch_report(lines, header):
+    report = header
+    for i, line in enumerate(lines):
+        if len(report) + len(line) > 3900:
+            report += f"\n… and {len(lines) - i} more"
+            break
+        report += f"\n{line}"
+    return report
+
+async def post_bulk(update: Update, context: ContextTypes.DEFAULT_TYPE, device_codenames):
+    redis_client: redis.Redis = context.bot_data["redis"]
+    device_index: DeviceIndex = context.bot_data["device_index"]
+    device_codenames = list(dict.fromkeys(device_codenames))
+    total = len(device_codenames)
+    lines = []
+    unknown = set()
+    if len(device_index):
+        # Misses are still fetched: the device may be newer than the index
+        unknown = {c for c in device_codenames if device_index.resolve(c) is None}
+        device_codenames = list(dict.fromkeys(device_index.resolve(c) or c for c in device_codenames))
+    status_msg = await update.message.reply_text(f"⏳ Fetching {len(device_codenames)} devices...")
+
+    results = await fetch_many_rom_data(context.bot_data["ota_cache"], device_codenames)
+    if unknown:
+        await device_index.learn(redis_client, {c: results.get(c) for c in unknown})
+
+    drafts = {}
+    for device_codename, data in results.items():
+        if not data:
+            reason = "unknown codename" if device_codename in unknown else "failed to fetch updates.json"
+            lines.append(f"❌ <code>{html.escape(device_codename)}</code>: {reason}")
+            continue
+        poster_username = data.get("maintainer_name") or update.effective_user.username or update.effective_user.first_name
+        # Render now so oversized captions are caught before approval
+        caption = max((c for _, c in render_post_targets(data, poster_username)), key=len)
+        if len(caption) > CAPTION_LIMIT:
+            lines.append(f"❌ <code>{html.escape(device_codename)}</code>: caption too long ({len(caption)} chars)")
+            continue
+        drafts[device_codename] = {
+            "id": secrets.token_urlsafe(8),
+            "data": data,
+            "notes": [],
+            "poster_username": poster_username,
+            "user_id": update.effective_user.id,
+        }
+        cached = " (cached, OTA source unreachable)" if data.get("stale_since") else ""
+        lines.append(
+            f"✅ <code>{html.escape(device_codename)}</code>: "
+            f"{html.escape(str(data.get('device_name')))} v{html.escape(str(data.get('version')))}{cached}"
+        )
+
+    if not drafts:
+        await status_msg.edit_text(format_batch_report(lines, "<b>Nothing to post.</b>"), parse_mode=ParseMode.HTML)
+        return
+
+    batch = {
+        "id": secrets.token_urlsafe(8),
+        "drafts": {c: d["id"] for c, d in drafts.items()},
+    }
+    try:
+        await save_drafts(redis_client, drafts.values())
+        await run_redis_command(redis_client, "set", batch_key(batch["id"]), json.dumps(batch), ex=DRAFT_TTL)
+    except RedisUnavailableError:
+        await status_msg.edit_text("⚠️ Redis is unavailable right now. Please try again later.")
+        return
+
+    header = f"<b>Bulk release: {len(drafts)} ready, {total - len(drafts)} failed.</b>\nAn admin must approve this batch."
+    await status_msg.edit_text(
+        format_batch_report(lines, header),
+        parse_mode=ParseMode.HTML,
+        reply_markup=batch_keyboard(batch["id"], len(drafts))
+    )
+
+async def send_batch(bot, redis_client, banner_cache, history, batch, chat_id, message_id):
+    draft_ids = list(batch["drafts"].values())
+    try:
+        raw_drafts = await run_redis_command(redis_client, "mget", [draft_key(d) for d in draft_ids])
+    except RedisUnavailableError:
+        await bot.send_message(chat_id=chat_id, text="⚠️ Redis is unavailable. The batch was not posted.")
+        return
+
+    lines = []
+    sent = 0
+    for device_codename, raw_draft in zip(batch["drafts"], raw_drafts):
+        if not raw_draft:
+            lines.append(f"❌ <code>{html.escape(device_codename)}</code>: draft expired")
+            continue
+        draft = json.loads(raw_draft)
+        banner_file_id = banner_cache.for_record(draft["data"])
+        if not banner_file_id:
+            lines.append(f"❌ <code>{html.escape(device_codename)}</code>: no banner set")
+            continue
+        posted, errors = await send_post(
+            bot,
+            banner_file_id,
+            render_post_targets(draft["data"], draft["poster_username"], draft["notes"]),
+            build_keyboard(draft["data"])
+        )
+        await record_post(history, draft, banner_file_id, posted)
+        if posted:
+            sent += 1
+        if not errors:
+            lines.append(f"✅ <code>{html.escape(device_codename)}</code>")
+        else:
+            failed = "; ".join(f"{target}: {html.escape(str(e))}" for target, e in errors.items())
+            lines.append(f"❌ <code>{html.escape(device_codename)}</code>: {failed}")
+
+    try:
+        await run_redis_pipeline(
+            redis_client,
+            lambda pipe: pipe.delete(batch_key(batch["id"]), *[draft_key(d) for d in draft_ids])
+        )
+    except RedisUnavailableError:
+        pass
+
+    header = f"<b>Bulk release finished: {sent}/{len(draft_ids)} posted to {describe_targets()}.</b>"
+    await bot.edit_message_text(
+        chat_id=chat_id,
+        message_id=message_id,
+        text=format_batch_report(lines, header),
+        parse_mode=ParseMode.HTML
+    )
+
+async def batch_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, action, batch_id):
+    query = update.callback_query
+    redis_client: redis.Redis = context.bot_data["redis"]
+
+    if query.from_user.id not in SETTINGS.admin_user_ids:
+        await query.answer("Only admins can approve or cancel a bulk release.", show_alert=True)
+        return
+
+    try:
+        raw_batch = await run_redis_command(redis_client, "getdel", batch_key(batch_id))
+    except RedisUnavailableError:
+        await query.answer("Redis is unavailable right now. Please try again later.", show_alert=True)
+        return
+
+    # GETDEL makes the approval one-shot, so a double tap cannot post twice
+    if not raw_batch:
+        await query.answer("This batch has expired or was already handled.", show_alert=True)
+        await query.edit_message_reply_markup(None)
+        return
+    batch = json.loads(raw_batch)
+
+    await query.answer()
+    if action == "batch_cancel":
+        await query.edit_message_reply_markup(None)
+        await query.message.reply_text("❌ Bulk release canceled.")
+        try:
+            await run_redis_command(redis_client, "delete", *[draft_key(d) for d in batch["drafts"].values()])
+        except RedisUnavailableError:
+            pass
+        return
+
+    await query.edit_message_text(f"⏳ Posting {len(batch['drafts'])} devices to {describe_targets()}...")
+    context.application.create_task(
+        send_batch(
+            context.bot, redis_client, context.bot_data["banner_cache"], context.bot_data["history"], batch,
+            query.message.chat_id, query.message.message_id
+        )
+    )
+
+# === SCHEDULED POSTS ===
+# A scheduled post is rendered when it is scheduled and stored in a hash; a
+# sorted set orders the job ids by due time. Due jobs are claimed by a Lua
+# script that moves them to a "claimed" set scored by a lease deadline, so two
+# replicas never claim the same job and jobs of a crashed replica come back
+# once their lease runs out. Schedulers sleep until the next due time and are
+# woken early through SCHEDULE_CHANNEL when a job is added.
+SCHEDULE_DUE_KEY = "scheduled:due"
+SCHEDULE_CLAIMED_KEY = "scheduled:claimed"
+SCHEDULE_PAYLOADS_KEY = "scheduled:payloads"
+SCHEDULE_CHANNEL = "scheduled:wake"
+SCHEDULE_PRESETS = ((15, "15 min"), (60, "1 hour"), (180, "3 hours"), (1440, "24 hours"))
+
+# KEYS: due, payloads, draft; ARGV: job id, due time, payload, wake channel.
+# Consumes the draft so a double tap cannot schedule the same post twice.
+SCHEDULE_ADD_SCRIPT = """
+if redis.call('DEL', KEYS[3]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[3])
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+redis.call('PUBLISH', ARGV[4], ARGV[2])
+return 1
+"""
+
+# KEYS: due, claimed, payloads; ARGV: now, batch size, lease deadline
+SCHEDULE_CLAIM_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+for _, id in ipairs(expired) do
+    redis.call('ZREM', KEYS[2], id)
+    redis.call('ZADD', KEYS[1], ARGV[1], id)
+end
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+local claimed = {}
+for _, id in ipairs(ids) do
+    redis.call('ZREM', KEYS[1], id)
+    local payload = redis.call('HGET', KEYS[3], id)
+    if payload then
+        redis.call('ZADD', KEYS[2], ARGV[3], id)
+        table.insert(claimed, payload)
+    end
+end
+return claimed
+"""
+
+# KEYS: due, payloads; ARGV: job id. Only jobs that are not claimed yet can be cancelled.
+SCHEDULE_CANCEL_SCRIPT = """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('HDEL', KEYS[2], ARGV[1])
+return 1
+"""
+
+def schedule_keyboard(draft_id):
+    presets = [
+        InlineKeyboardButton(f"In {label}", callback_data=f"schedule_in:{draft_id}:{minutes}")
+        for minutes, label in SCHEDULE_PRESETS
+    ]
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton("Yes, add notes", callback_data=f"notes_yes:{device_codename}:{poster_username}:{user_id}")],
-        [InlineKeyboardButton("No, continue", callback_data=f"notes_no:{device_codename}:{poster_username}:{user_id}")]
+        presets[:2],
+        presets[2:],
+        [InlineKeyboardButton("🗓 Custom time", callback_data=f"schedule_custom:{draft_id}")],
+        [InlineKeyboardButton("⬅️ Back", callback_data=f"notes_no:{draft_id}")]
     ])
 
+def unschedule_keyboard(job_id):
+    return InlineKeyboardMarkup([[InlineKeyboardButton("❌ Unschedule", callback_data=f"unschedule:{job_id}")]])
+
+def format_schedule_time(timestamp):
+    return datetime.fromtimestamp(timestamp, SCHEDULE_ZONE).strftime("%d %B %Y %H:%M %Z")
+
+def parse_schedule_time(text, now=None):
+    """
+    Reads "+90m" / "2h" / "1d", "HH:MM" (next occurrence) or
+    "YYYY-MM-DD HH:MM" in SCHEDULE_TZ. Returns a timestamp or None.
+    """
+    now = time.time() if now is None else now
+    text = text.strip().lower()
+    match = re.fullmatch(r"\+?\s*(\d+)\s*(m|min|h|d)", text)
+    if match:
+        unit = {"m": 60, "min": 60, "h": 3600, "d": 86400}[match.group(2)]
+        return now + int(match.group(1)) * unit
+
+    local_now = datetime.fromtimestamp(now, SCHEDULE_ZONE)
+    try:
+        parsed = datetime.strptime(text, "%H:%M")
+        due = local_now.replace(hour=parsed.hour, minute=parsed.minute, second=0, microsecond=0)
+        if due.timestamp() <= now:
+            due += timedelta(days=1)
+        return due.timestamp()
+    except ValueError:
+        pass
+    try:
+        return datetime.strptime(text, "%Y-%m-%d %H:%M").replace(tzinfo=SCHEDULE_ZONE).timestamp()
+    except ValueError:
+        return None
+
+class PostScheduler:
+    """Publishes scheduled posts from the shared Redis queue."""
+
+    def __init__(self, redis_client, history, batch_size=SCHEDULE_BATCH, lease=SCHEDULE_LEASE):
+        self.redis_client = redis_client
+        self.history = history
+        self.batch_size = batch_size
+        self.lease = lease
+        self._wake = asyncio.Event()
+        self._add_script = redis_client.register_script(SCHEDULE_ADD_SCRIPT)
+        self._claim_script = redis_client.register_script(SCHEDULE_CLAIM_SCRIPT)
+        self._cancel_script = redis_client.register_script(SCHEDULE_CANCEL_SCRIPT)
+
+    async def schedule(self, draft_id, job):
+        """Stores `job` and consumes its draft; False if the draft was already used."""
+        added = await run_redis_script(
+            self._add_script,
+            keys=(SCHEDULE_DUE_KEY, SCHEDULE_PAYLOADS_KEY, draft_key(draft_id)),
+            args=(job["id"], job["due"], json.dumps(job), SCHEDULE_CHANNEL)
+        )
+        return bool(added)
+
+    async def get(self, job_id):
+        raw = await run_redis_command(self.redis_client, "hget", SCHEDULE_PAYLOADS_KEY, job_id)
+        return json.loads(raw) if raw else None
+
+    async def pending(self, limit=20):
+        ids = await run_redis_command(self.redis_client, "zrange", SCHEDULE_DUE_KEY, 0, limit - 1)
+        if not ids:
+            return []
+        raw_jobs = await run_redis_command(self.redis_client, "hmget", SCHEDULE_PAYLOADS_KEY, ids)
+        return [json.loads(raw) for raw in raw_jobs if raw]
+
+    async def cancel(self, job_id):
+        return bool(await run_redis_script(
+            self._cancel_script, keys=(SCHEDULE_DUE_KEY, SCHEDULE_PAYLOADS_KEY), args=(job_id,)
+        ))
+
+    async def _claim(self):
+        now = time.time()
+        raw_jobs = await run_redis_script(
+            self._claim_script,
+            keys=(SCHEDULE_DUE_KEY, SCHEDULE_CLAIMED_KEY, SCHEDULE_PAYLOADS_KEY),
+            args=(now, self.batch_size, now + self.lease)
+        )
+        return [json.loads(raw) for raw in raw_jobs]
+
+    async def _finish(self, job_ids):
+        await run_redis_pipeline(
+            self.redis_client,
+            lambda pipe: (pipe.zrem(SCHEDULE_CLAIMED_KEY, *job_ids), pipe.hdel(SCHEDULE_PAYLOADS_KEY, *job_ids))
+        )
+
+    async def _seconds_until_next(self):
+        # The earliest due job, or the earliest lease that may need reclaiming
+        first_due, first_lease = await run_redis_pipeline(
+            self.redis_client,
+            lambda pipe: (
+                pipe.zrange(SCHEDULE_DUE_KEY, 0, 0, withscores=True),
+                pipe.zrange(SCHEDULE_CLAIMED_KEY, 0, 0, withscores=True)
+            )
+        )
+        scores = [score for _, score in first_due + first_lease]
+        if not scores:
+            return SCHEDULE_MAX_SLEEP
+        return min(max(min(scores) - time.time(), 0), SCHEDULE_MAX_SLEEP)
+
+    async def run(self, bot):
+        while True:
+            self._wake.clear()
+            try:
+                jobs = await self._claim()
+                if jobs:
+                    await self._publish(bot, jobs)
+                    if len(jobs) == self.batch_size:
+                        continue
+                delay = await self._seconds_until_next()
+            except RedisUnavailableError:
+                delay = 5
+            try:
+                await asyncio.wait_for(self._wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def listen(self):
+        """Wakes the scheduler loop whenever any replica adds a job."""
+        while True:
+            try:
+                async with self.redis_client.pubsub(ignore_subscribe_messages=True) as pubsub:
+                    await pubsub.subscribe(SCHEDULE_CHANNEL)
+                    self._wake.set()
+                    async for _ in pubsub.listen():
+                        self._wake.set()
+            except (RedisError, OSError) as e:
+                print(f"[WARNING] Schedule wake-up listener disconnected: {e}")
+                await asyncio.sleep(5)
+
+    async def _publish(self, bot, jobs):
+        # One batch goes out in due order through the bulk send queue, which
+        # keeps the channel under its flood limits
+        for job in sorted(jobs, key=lambda j: j["due"]):
+            sent, errors = await send_post(
+                bot, job["photo"], job["posts"], InlineKeyboardMarkup.de_json(job["reply_markup"], bot)
+            )
+            METRICS.inc("scheduled_posts", result="failed" if errors else "sent")
+            if "draft" in job:
+                await record_post(self.history, job["draft"], job["photo"], sent)
+            if not errors:
+                status = f"✅ Scheduled post for <code>{job['codename']}</code> was published to {', '.join(map(str, sent))}."
+            else:
+                failed = "; ".join(f"{target}: {html.escape(str(e))}" for target, e in errors.items())
+                status = f"❌ Scheduled post for <code>{job['codename']}</code> failed for {failed}"
+            try:
+                await self._finish([job["id"]])
+            except RedisUnavailableError:
+                pass
+            try:
+                await bot.edit_message_text(
+                    chat_id=job["notify_chat_id"],
+                    message_id=job["notify_message_id"],
+                    text=status,
+                    parse_mode=ParseMode.HTML
+                )
+            except Exception as e:
+                print(f"[WARNING] Could not report scheduled post {job['id']}: {e}")
+
+async def schedule_draft(context, draft, due, chat_id):
+    """Renders the draft, queues it for `due` and reports in `chat_id`."""
+    codename = draft["data"]["device_codename"]
+    if due <= time.time() or due > time.time() + SCHEDULE_MAX_DAYS * 86400:
+        await context.bot.send_message(
+            chat_id=chat_id, text=f"Please pick a time in the next {SCHEDULE_MAX_DAYS} days."
+        )
+        return False
+
+    banner_file_id = context.bot_data["banner_cache"].for_record(draft["data"])
+    if not banner_file_id:
+        await context.bot.send_message(chat_id=chat_id, text="Failed to schedule: no banner is set. Please /setbanner.")
+        return False
+
+    status_msg = await context.bot.send_message(chat_id=chat_id, text=f"⏳ Scheduling {codename}...")
+    job = {
+        "id": secrets.token_urlsafe(8),
+        "due": due,
+        "codename": codename,
+        "photo": banner_file_id,
+        "posts": render_post_targets(draft["data"], draft["poster_username"], draft["notes"]),
+        "reply_markup": build_keyboard(draft["data"]).to_dict(),
+        # Kept for the post history once the job is published
+        "draft": {k: draft[k] for k in ("data", "poster_username", "notes")},
+        "user_id": draft["user_id"],
+        "notify_chat_id": chat_id,
+        "notify_message_id": status_msg.message_id,
+    }
+    try:
+        scheduled = await context.bot_data["scheduler"].schedule(draft["id"], job)
+    except RedisUnavailableError:
+        await status_msg.edit_text("⚠️ Redis is unavailable right now. Please try again later.")
+        return False
+    if not scheduled:
+        await status_msg.edit_text("This draft was already posted or scheduled.")
+        return False
+
+    await status_msg.edit_text(
+        f"🕒 <code>{codename}</code> will be posted to {describe_targets()} on {format_schedule_time(due)}.",
+        parse_mode=ParseMode.HTML,
+        reply_markup=unschedule_keyboard(job["id"])
+    )
+    return True
+
+async def unschedule_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, job_id):
+    query = update.callback_query
+    scheduler: PostScheduler = context.bot_data["scheduler"]
+    try:
+        job = await scheduler.get(job_id)
+        if job and query.from_user.id not in SETTINGS.admin_user_ids and query.from_user.id != job["user_id"]:
+            await query.answer("You are not allowed to perform this action.", show_alert=True)
+            return
+        cancelled = job is not None and await scheduler.cancel(job_id)
+    except RedisUnavailableError:
+        await query.answer("Redis is unavailable right now. Please try again later.", show_alert=True)
+        return
+
+    if not cancelled:
+        await query.answer("This post was already published or unscheduled.", show_alert=True)
+        await query.edit_message_reply_markup(None)
+        return
+    await query.answer()
+    await query.edit_message_text(
+        f"❌ Scheduled post for <code>{job['codename']}</code> was cancelled.", parse_mode=ParseMode.HTML
+    )
+
 # === COMMANDS ===
 
 # /setbanner command
@@ -187,29 +2687,29 @@ async def set_banner_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
 
-    if chat_id not in ALLOWED_CHAT_IDS:
+    if chat_id not in SETTINGS.allowed_chat_ids:
         await update.message.reply_text("Sorry, this command is only allowed in specific groups.")
         return
 
-    if user_id not in ADMIN_USER_IDS:
+    if user_id not in SETTINGS.admin_user_ids:
         await update.message.reply_text("Sorry, you are not authorized to use this command.")
         return
 
-    if not update.message.reply_to_message or not update.message.reply_to_message.photo:
+    field = parse_banner_scope(context.args)
+    if field is None or not update.message.reply_to_message or not update.message.reply_to_message.photo:
         await update.message.reply_text(
-            "Usage: Reply to a photo with `/setbanner` to capture its ID."
+            "Usage: Reply to a photo with `/setbanner` to capture its ID.\n"
+            "Add `device <codename>` or `release <name>` to set a banner for one device or release."
         )
         return
 
     file_id = update.message.reply_to_message.photo[-1].file_id
     
     try:
-        redis_client: redis.Redis = context.bot_data["redis"]
-        # Use the helper to run the sync command
-        await run_redis_command(redis_client, "set", "banner_file_id", file_id)
+        await context.bot_data["banner_cache"].set(field, file_id)
         
         await update.message.reply_text(
-            f"✅ Banner ID set successfully.\n",
+            f"✅ Banner ID set successfully for {describe_banner_field(field)}.\n",
             parse_mode=ParseMode.HTML
         )
     except Exception as e:
@@ -221,102 +2721,469 @@ async def remove_banner_command(update: Update, context: ContextTypes.DEFAULT_TY
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
 
-    if chat_id not in ALLOWED_CHAT_IDS:
+    if chat_id not in SETTINGS.allowed_chat_ids:
+        await update.message.reply_text("Sorry, this command is only allowed in specific groups.")
+        return
+
+    if user_id not in SETTINGS.admin_user_ids:
+        await update.message.reply_text("Sorry, you are not authorized to use this command.")
+        return
+
+    field = parse_banner_scope(context.args)
+    if field is None:
+        await update.message.reply_text("Usage: /removebanner [device <codename> | release <name>]")
+        return
+        
+    try:
+        removed = await context.bot_data["banner_cache"].remove(field)
+        
+        await update.message.reply_text(
+            f"✅ Banner removed successfully for {describe_banner_field(field)}." if removed
+            else f"No banner is set for {describe_banner_field(field)}.",
+            parse_mode=ParseMode.HTML
+        )
+    except Exception as e:
+        print(f"[ERROR] Failed to remove banner from Redis: {e}")
+        await update.message.reply_text(f"Failed to remove banner from Redis: {e}")
+
+# view_banner_command
+async def view_banner_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    if chat_id not in SETTINGS.allowed_chat_ids:
+        await update.message.reply_text("Sorry, this command is only allowed in specific groups.")
+        return
+
+    field = parse_banner_scope(context.args)
+    if field is None:
+        await update.message.reply_text("Usage: /banner [device <codename> | release <name>]")
+        return
+
+    banner_cache: BannerCache = context.bot_data["banner_cache"]
+    banner_file_id = banner_cache.get(field)
+    if banner_file_id:
+        caption = f"This is the currently used banner for {describe_banner_field(field)}."
+        overrides = [describe_banner_field(f) for f in banner_cache.fields() if f != field]
+        if not context.args and overrides:
+            caption += f"\nOverrides: {', '.join(overrides)}"
+        try:
+            await update.message.reply_photo(
+                photo=banner_file_id,
+                caption=caption[:CAPTION_LIMIT],
+                parse_mode=ParseMode.HTML
+            )
+        except Exception as e:
+            await update.message.reply_text(f"Failed to send banner using file_id: {e}")
+    else:
+        await update.message.reply_text(
+            "Banner not set. Please set one using `/setbanner`."
+        )
+
+# post_command
+async def post_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    if chat_id not in SETTINGS.allowed_chat_ids:
+        await update.message.reply_text("Sorry, this command is only allowed in specific groups.")
+        return
+
+    redis_client: redis.Redis = context.bot_data["redis"]
+    banner_cache: BannerCache = context.bot_data["banner_cache"]
+    if not banner_cache:
+        await update.message.reply_text(
+            f"⚠️ Banner not found.\n"
+            "Please set a banner using `/setbanner`.",
+            parse_mode=ParseMode.HTML
+        )
+        return
+
+    if not context.args:
+        await update.message.reply_text(
+            "Usage:\n/post <codename> [more codenames...]\nExample: /post surya"
+        )
+        return
+
+    if len(context.args) > 1:
+        await post_bulk(update, context, context.args)
+        return
+
+    device_codename = context.args[0]
+
+    device_index: DeviceIndex = context.bot_data["device_index"]
+    canonical = device_index.resolve(device_codename)
+    device_codename = canonical or device_codename
+
+    data = await fetch_rom_data(context.bot_data["ota_cache"], device_codename)
+    if not data and canonical is None and len(device_index):
+        # Not in the index and not upstream either: most likely a typo
+        suggestions = device_index.suggest(device_codename)
+        hint = f"\nDid you mean: {', '.join(f'<code>{c}</code>' for c in suggestions)}?" if suggestions else ""
+        await update.message.reply_text(
+            f"Unknown codename <code>{html.escape(device_codename)}</code>.{hint}",
+            parse_mode=ParseMode.HTML
+        )
+        return
+    if not data:
+        await update.message.reply_text(
+            f"Failed to fetch data for <code>{html.escape(device_codename)}</code>. Make sure the JSON file exists.",
+            parse_mode=ParseMode.HTML
+        )
+        return
+    if canonical is None:
+        await device_index.learn(redis_client, {device_codename: data})
+
+    banner_file_id = banner_cache.for_record(data)
+    if not banner_file_id:
+        await update.message.reply_text(
+            f"⚠️ No banner applies to <code>{html.escape(device_codename)}</code>.\n"
+            "Please set a default banner using `/setbanner`.",
+            parse_mode=ParseMode.HTML
+        )
+        return
+
+    poster_username = data.get("maintainer_name") or update.effective_user.username or update.effective_user.first_name
+    try:
+        draft = await create_draft(redis_client, data, poster_username, update.effective_user.id)
+    except RedisUnavailableError:
+        await update.message.reply_text("⚠️ Redis is unavailable right now. Please try again later.")
+        return
+
+    post_preview = format_post(data, poster_username, notes_list=None) 
+    notice = stale_notice(data)
+    if notice and len(post_preview) + len(notice) + 2 <= CAPTION_LIMIT:
+        post_preview = f"{notice}\n\n{post_preview}"
+    keyboard = ask_notes_keyboard(draft["id"])
+
+    try:
+        await update.message.reply_photo(
+            photo=banner_file_id, 
+            caption=post_preview,
+            parse_mode=ParseMode.HTML,
+            reply_markup=keyboard
+        )
+    except Exception as e:
+        await update.message.reply_text(f"Failed to send preview: {e}")
+
+# /postall command
+async def post_all_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    user_id = update.effective_user.id
+
+    if chat_id not in SETTINGS.allowed_chat_ids:
+        await update.message.reply_text("Sorry, this command is only allowed in specific groups.")
+        return
+
+    if user_id not in SETTINGS.admin_user_ids:
+        await update.message.reply_text("Sorry, you are not authorized to use this command.")
+        return
+
+    redis_client: redis.Redis = context.bot_data["redis"]
+    banner_cache: BannerCache = context.bot_data["banner_cache"]
+    if not banner_cache:
+        await update.message.reply_text(
+            f"⚠️ Banner not found.\n"
+            "Please set a banner using `/setbanner`.",
+            parse_mode=ParseMode.HTML
+        )
+        return
+
+    device_index: DeviceIndex = context.bot_data["device_index"]
+    if not len(device_index):
+        await device_index.refresh(context.bot_data["http"], context.bot_data["ota_cache"], redis_client)
+    device_codenames = device_index.codenames()
+    if not device_codenames:
+        await update.message.reply_text("Failed to load the device list from the OTA repository.")
+        return
+
+    await post_bulk(update, context, device_codenames)
+
+# /devices command
+async def devices_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    if chat_id not in SETTINGS.allowed_chat_ids:
+        await update.message.reply_text("Sorry, this command is only allowed in specific groups.")
+        return
+
+    device_index: DeviceIndex = context.bot_data["device_index"]
+    if not len(device_index):
+        await update.message.reply_text("The device index is still loading. Please try again shortly.")
+        return
+
+    if context.args:
+        maintainer = " ".join(context.args)
+        entries = device_index.by_maintainer(maintainer)
+        if not entries:
+            await update.message.reply_text(
+                f"No devices found for maintainer <b>{html.escape(maintainer)}</b>.",
+                parse_mode=ParseMode.HTML
+            )
+            return
+        header = f"<b>Devices maintained by {html.escape(maintainer)}:</b>"
+    else:
+        entries = [device_index.get(c) for c in device_index.codenames()]
+        header = f"<b>{len(entries)} known devices:</b>"
+
+    lines = [
+        f"• <code>{e.codename}</code> {html.escape(e.device_name or '')}"
+        + (f" ({html.escape(e.maintainer)})" if e.maintainer else "")
+        for e in entries
+    ]
+    await update.message.reply_text(format_batch_report(lines, header), parse_mode=ParseMode.HTML)
+
+# /scheduled command
+async def scheduled_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    if chat_id not in SETTINGS.allowed_chat_ids:
+        await update.message.reply_text("Sorry, this command is only allowed in specific groups.")
+        return
+
+    try:
+        jobs = await context.bot_data["scheduler"].pending()
+    except RedisUnavailableError:
+        await update.message.reply_text("⚠️ Redis is unavailable right now. Please try again later.")
+        return
+
+    # Admins see every pending post, maintainers only their own
+    user_id = update.effective_user.id
+    if user_id not in SETTINGS.admin_user_ids:
+        jobs = [job for job in jobs if job["user_id"] == user_id]
+    if not jobs:
+        await update.message.reply_text("No posts are scheduled.")
+        return
+
+    lines = [f"• <code>{job['codename']}</code>: {format_schedule_time(job['due'])}" for job in jobs]
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"❌ Unschedule {job['codename']}", callback_data=f"unschedule:{job['id']}")]
+        for job in jobs
+    ])
+    await update.message.reply_text(
+        "<b>Scheduled posts</b>\n" + "\n".join(lines), parse_mode=ParseMode.HTML, reply_markup=keyboard
+    )
+
+# /history command
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    if chat_id not in SETTINGS.allowed_chat_ids:
         await update.message.reply_text("Sorry, this command is only allowed in specific groups.")
         return
 
-    if user_id not in ADMIN_USER_IDS:
-        await update.message.reply_text("Sorry, you are not authorized to use this command.")
+    if not context.args:
+        await update.message.reply_text("Usage:\n/history <codename>\nExample: /history surya")
         return
-        
+
+    device_codename = context.args[0]
+    device_index: DeviceIndex = context.bot_data["device_index"]
+    if len(device_index):
+        device_codename = device_index.resolve(device_codename) or device_codename
+
     try:
-        redis_client: redis.Redis = context.bot_data["redis"]
-        # Use the helper to run the sync command
-        await run_redis_command(redis_client, "delete", "banner_file_id")
-        
+        entries = await context.bot_data["history"].for_device(device_codename)
+    except RedisUnavailableError:
+        await update.message.reply_text("⚠️ Redis is unavailable right now. Please try again later.")
+        return
+    if not entries:
         await update.message.reply_text(
-            f"✅ Banner removed successfully."
+            f"Nothing was posted for <code>{html.escape(device_codename)}</code> yet.", parse_mode=ParseMode.HTML
         )
-    except Exception as e:
-        print(f"[ERROR] Failed to remove banner from Redis: {e}")
-        await update.message.reply_text(f"Failed to remove banner from Redis: {e}")
+        return
 
-# view_banner_command
-async def view_banner_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    lines = [format_history_entry(entry) for entry in entries]
+    await update.message.reply_text(
+        f"<b>Posts for {html.escape(entries[0]['data'].get('device_name') or device_codename)}</b> "
+        f"(<code>{html.escape(device_codename)}</code>)\n" + "\n".join(lines),
+        parse_mode=ParseMode.HTML,
+        disable_web_page_preview=True
+    )
+
+# /latest command
+async def latest_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    if chat_id not in ALLOWED_CHAT_IDS:
+    if chat_id not in SETTINGS.allowed_chat_ids:
         await update.message.reply_text("Sorry, this command is only allowed in specific groups.")
         return
 
-    redis_client: redis.Redis = context.bot_data["redis"]
-    # Use the helper to run the sync command
-    banner_file_id = await run_redis_command(redis_client, "get", "banner_file_id")
+    limit = HISTORY_LIST_LIMIT
+    if context.args and context.args[0].isdigit():
+        limit = min(max(int(context.args[0]), 1), 50)
 
-    if banner_file_id:
-        try:
-            await update.message.reply_photo(
-                photo=banner_file_id,
-                caption="This is the currently used banner."
-            )
-        except Exception as e:
-            await update.message.reply_text(f"Failed to send banner using file_id: {e}")
-    else:
-        await update.message.reply_text(
-            "Banner not set. Please set one using `/setbanner`."
-        )
+    try:
+        entries = await context.bot_data["history"].latest(limit)
+    except RedisUnavailableError:
+        await update.message.reply_text("⚠️ Redis is unavailable right now. Please try again later.")
+        return
+    if not entries:
+        await update.message.reply_text("Nothing was posted yet.")
+        return
 
-# post_command
-async def post_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    lines = [format_history_entry(entry, with_codename=True) for entry in entries]
+    await update.message.reply_text(
+        "<b>Latest releases</b>\n" + "\n".join(lines), parse_mode=ParseMode.HTML, disable_web_page_preview=True
+    )
+
+# /config command
+def validate_setting(name, value, update):
+    """Returns an error message for a bad override, or None."""
+    if name in ("ALLOWED_CHAT_IDS", "ADMIN_USER_IDS"):
+        ids, invalid = parse_id_list(value)
+        if invalid:
+            return f"Invalid IDs: {', '.join(invalid)}"
+        # Never lock the caller out of /config
+        if name == "ALLOWED_CHAT_IDS" and update.effective_chat.id not in ids:
+            return "The new list must include this chat."
+        if name == "ADMIN_USER_IDS" and update.effective_user.id not in ids:
+            return "The new list must include your own ID."
+    if name == "POST_TARGETS":
+        unknown = {item.rpartition("=")[2].strip() for item in value.split(",") if "=" in item} - set(POST_TEMPLATES)
+        if unknown:
+            return f"Unknown templates: {', '.join(sorted(unknown))}. Available: {', '.join(POST_TEMPLATES)}"
+    if name == "BASE_URL" and not value.startswith(("http://", "https://")):
+        return "BASE_URL must be an http(s) URL."
+    return None
+
+async def config_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    if chat_id not in ALLOWED_CHAT_IDS:
+    user_id = update.effective_user.id
+
+    if chat_id not in SETTINGS.allowed_chat_ids:
         await update.message.reply_text("Sorry, this command is only allowed in specific groups.")
         return
 
-    redis_client: redis.Redis = context.bot_data["redis"]
-    # Use the helper to run the sync command
-    banner_file_id = await run_redis_command(redis_client, "get", "banner_file_id")
+    if user_id not in SETTINGS.admin_user_ids:
+        await update.message.reply_text("Sorry, you are not authorized to use this command.")
+        return
 
-    if not banner_file_id:
+    settings_store: SettingsStore = context.bot_data["settings"]
+    args = context.args or []
+    action = args[0].lower() if args else ""
+
+    if action in ("set", "unset") and len(args) >= 2 and args[1].upper() in SETTINGS_DEFAULTS:
+        name = args[1].upper()
+        value = " ".join(args[2:]).strip() if action == "set" else None
+        if action == "set":
+            error = "Usage: /config set <name> <value>" if not value else validate_setting(name, value, update)
+        else:
+            # Check the value the env (or default) would bring back
+            error = validate_setting(name, settings_store.without(name).values[name], update)
+        if error:
+            await update.message.reply_text(error)
+            return
+        try:
+            await settings_store.set(name, value)
+        except RedisUnavailableError:
+            await update.message.reply_text("⚠️ Redis is unavailable right now. Please try again later.")
+            return
+        effective = SETTINGS.values[name] or "(empty)"
         await update.message.reply_text(
-            f"⚠️ Banner not found.\n"
-            "Please set a banner using `/setbanner`.",
+            f"✅ <code>{name}</code> is now <code>{html.escape(effective)}</code> ({SETTINGS.sources[name]}) on every replica.",
             parse_mode=ParseMode.HTML
         )
         return
 
-    if not context.args:
+    if action == "reload":
+        try:
+            await run_redis_command(context.bot_data["redis"], "publish", SETTINGS_CHANNEL, "reload")
+        except RedisUnavailableError:
+            await settings_store.reload(reread_env=True)
+            await update.message.reply_text("⚠️ Redis is unavailable; only this replica was reloaded.")
+            return
+        await update.message.reply_text("🔄 Every replica is reloading its settings.")
+        return
+
+    if action:
         await update.message.reply_text(
-            "Usage:\n/post <codename>\nExample: /post surya"
+            "Usage:\n/config\n/config set <name> <value>\n/config unset <name>\n/config reload\n"
+            f"Names: {', '.join(SETTINGS_DEFAULTS)}"
         )
         return
 
-    device_codename = context.args[0]
-    
-    data = fetch_rom_data(device_codename)
-    if not data:
-        await update.message.reply_text(
-            f"Failed to fetch data for <code>{device_codename}</code>. Make sure the JSON file exists.",
-            parse_mode=ParseMode.HTML
+    lines = ["<b>⚙️ Settings</b>"]
+    for name in SETTINGS_DEFAULTS:
+        lines.append(
+            f"• <code>{name}</code> = <code>{html.escape(SETTINGS.values[name] or '(empty)')}</code> ({SETTINGS.sources[name]})"
         )
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+
+# /stats command
+def format_latency(histogram):
+    if not histogram.count:
+        return "no data"
+    return f"p50 {histogram.quantile(0.5) * 1000:.0f} / p95 {histogram.quantile(0.95) * 1000:.0f} ms (n={histogram.count})"
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    user_id = update.effective_user.id
+
+    if chat_id not in SETTINGS.allowed_chat_ids:
+        await update.message.reply_text("Sorry, this command is only allowed in specific groups.")
         return
 
-    poster_username = data.get("maintainer_name", update.effective_user.username or update.effective_user.first_name)
-    post_preview = format_post(data, poster_username, notes_list=None) 
-    keyboard = ask_notes_keyboard(device_codename, poster_username, update.effective_user.id)
+    if user_id not in SETTINGS.admin_user_ids:
+        await update.message.reply_text("Sorry, you are not authorized to use this command.")
+        return
 
-    try:
-        await update.message.reply_photo(
-            photo=banner_file_id, 
-            caption=post_preview,
-            parse_mode=ParseMode.HTML,
-            reply_markup=keyboard
+    uptime = timedelta(seconds=int(time.time() - METRICS.started_at))
+    lines = [f"<b>📊 Bot stats</b> (uptime {uptime}, role {BOT_ROLE})", "", "<b>Handlers</b>"]
+    calls = METRICS.counters_by("handler_calls", "handler")
+    for handler in sorted(calls, key=calls.get, reverse=True):
+        errors = METRICS.counter("handler_errors", handler=handler)
+        lines.append(
+            f"• {handler}: {format_latency(METRICS.histogram('handler', handler=handler))}"
+            + (f", {errors} errors" if errors else "")
         )
-    except Exception as e:
-        await update.message.reply_text(f"Failed to send preview: {e}")
 
-# ... (handle_notes_reply remains exactly the same) ...
+    lookups = METRICS.counters_by("ota_cache_lookups", "result")
+    total = sum(lookups.values())
+    hits = sum(lookups.get(r, 0) for r in ("hit", "redis_hit", "revalidated"))
+    ota_cache: OtaCache = context.bot_data["ota_cache"]
+    lines += [
+        "",
+        "<b>OTA source</b>",
+        f"• Cache: {hits / total:.0%} hits of {total} lookups, {lookups.get('stale', 0)} stale, "
+        f"{lookups.get('error', 0)} errors" if total else "• Cache: no lookups yet",
+        f"• HTTP: {format_latency(METRICS.histogram('ota_http'))}, {METRICS.counter('ota_http_errors')} errors",
+        f"• Circuit: {ota_cache.breaker.state}",
+        "",
+        "<b>Redis</b>",
+        f"• {format_latency(METRICS.histogram('redis_command'))}, "
+        f"{sum(METRICS.counters_by('redis_command_errors', 'command').values())} errors",
+    ]
+
+    dispatcher = context.bot.rate_limiter
+    telegram_errors = sum(METRICS.counters_by("telegram_request_errors", "endpoint").values())
+    lines += [
+        "",
+        "<b>Telegram</b>",
+        f"• Sends: {format_latency(METRICS.histogram('telegram_request', endpoint='sendPhoto'))}",
+        f"• All calls: {format_latency(METRICS.histogram('telegram_request'))}, {telegram_errors} errors",
+    ]
+    if isinstance(dispatcher, SendDispatcher):
+        queue = dispatcher.stats()
+        lines.append(
+            f"• Queue: {queue['queued_interactive']} interactive, {queue['queued_bulk']} bulk, "
+            f"{queue['retried']} retried"
+        )
+    if isinstance(context.application.update_processor, OrderedUpdateProcessor):
+        lines.append(f"• Updates in flight: {context.application.update_processor.in_flight}")
+
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+
+# inline_query_handler
+async def inline_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.inline_query
+    if query.from_user.id not in SETTINGS.admin_user_ids:
+        await query.answer([], cache_time=INLINE_CACHE_TIME, is_personal=True)
+        return
+
+    results = context.bot_data["preview_cache"].search(query.query.strip())
+    await query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=True)
+
+# handle_notes_reply
 async def handle_notes_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
+
+    schedule_state = context.user_data.get('awaiting_schedule_for')
+    if (schedule_state and update.message.reply_to_message and
+            update.message.reply_to_message.message_id == schedule_state['prompt_message_id']):
+        await handle_schedule_reply(update, context, schedule_state)
+        return
     
     if 'awaiting_notes_for' not in context.user_data:
         return 
@@ -327,22 +3194,26 @@ async def handle_notes_reply(update: Update, context: ContextTypes.DEFAULT_TYPE)
         update.message.reply_to_message.message_id == state['prompt_message_id'] and
         user_id == state['user_id']):
         
-        notes_raw = update.message.text
-        notes_with_html_links = re.sub(r'\[(.*?)\]\((.*?)\)', r'<a href="\2">\1</a>', notes_raw)
-        notes_list = [f"- {line.strip()}" for line in notes_with_html_links.split("\n") if line.strip()]
-
-        device_codename = state['device_codename']
-        poster_username = state['poster_username']
+        notes_list = parse_notes(update.message.text)
         original_preview_message_id = state['original_preview_message_id']
+        redis_client: redis.Redis = context.bot_data["redis"]
 
-        data = fetch_rom_data(device_codename)
-        if not data:
-            await update.message.reply_text("Error: Failed to re-fetch device data. Please try the /post command again.")
+        try:
+            draft = await load_draft(redis_client, state['draft_id'])
+            if draft:
+                draft["notes"] = notes_list
+                await save_draft(redis_client, draft)
+        except RedisUnavailableError:
+            await update.message.reply_text("⚠️ Redis is unavailable right now. Please try again later.")
+            return
+
+        if not draft:
+            await update.message.reply_text("Error: This draft has expired. Please try the /post command again.")
             del context.user_data['awaiting_notes_for']
             return
 
-        post_with_notes = format_post(data, poster_username, notes_list)
-        keyboard = confirm_keyboard(device_codename, poster_username, user_id)
+        post_with_notes = format_post(draft["data"], draft["poster_username"], notes_list)
+        keyboard = await review_keyboard(context.bot_data["history"], draft)
 
         try:
             await context.bot.edit_message_caption(
@@ -363,24 +3234,80 @@ async def handle_notes_reply(update: Update, context: ContextTypes.DEFAULT_TYPE)
             del context.user_data['awaiting_notes_for']
 
 
+async def handle_schedule_reply(update: Update, context: ContextTypes.DEFAULT_TYPE, state):
+    if update.effective_user.id != state['user_id']:
+        return
+
+    due = parse_schedule_time(update.message.text)
+    if due is None:
+        # Keep waiting, so the maintainer can reply to the same prompt again
+        await update.message.reply_text("I couldn't read that time. Try +90m, 18:30 or 2025-01-31 18:30.")
+        return
+
+    try:
+        draft = await load_draft(context.bot_data["redis"], state['draft_id'])
+    except RedisUnavailableError:
+        await update.message.reply_text("⚠️ Redis is unavailable right now. Please try again later.")
+        return
+    if not draft:
+        del context.user_data['awaiting_schedule_for']
+        await update.message.reply_text("Error: This draft has expired. Please try the /post command again.")
+        return
+
+    if await schedule_draft(context, draft, due, update.effective_chat.id):
+        del context.user_data['awaiting_schedule_for']
+        try:
+            await context.bot.edit_message_reply_markup(
+                chat_id=update.effective_chat.id, message_id=state['original_preview_message_id'], reply_markup=None
+            )
+            await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=state['prompt_message_id'])
+        except Exception as e:
+            print(f"[WARNING] Could not tidy up the schedule prompt: {e}")
+
 # callback_handler
 async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     user_id = query.from_user.id
     redis_client: redis.Redis = context.bot_data["redis"]
 
-    # Handle "Yes, add notes"
-    if query.data.startswith("notes_yes:"):
-        try:
-            _, device_codename, poster_username, expected_user_id = query.data.split(":", 3)
-        except ValueError:
-            await query.edit_message_text("Error: Invalid callback data format.")
-            return
-            
-        if str(user_id) != expected_user_id:
-            await query.answer("You are not allowed to perform this action.", show_alert=True)
-            return
+    action, _, draft_id = query.data.partition(":")
+    if action in ("batch_send", "batch_cancel") and draft_id:
+        await batch_callback(update, context, action, draft_id)
+        return
+
+    if action == "unschedule" and draft_id:
+        await unschedule_callback(update, context, draft_id)
+        return
 
+    delay_minutes = None
+    if action == "schedule_in":
+        draft_id, _, delay_minutes = draft_id.partition(":")
+        delay_minutes = int(delay_minutes) if delay_minutes.isdigit() else None
+
+    if action not in (
+        "notes_yes", "notes_no", "cancel_post", "confirm_send", "edit_post",
+        "schedule", "schedule_in", "schedule_custom"
+    ) or not draft_id or (action == "schedule_in" and delay_minutes is None):
+        await query.answer("Error: Invalid callback data format.", show_alert=True)
+        return
+
+    try:
+        draft = await load_draft(redis_client, draft_id)
+    except RedisUnavailableError:
+        await query.answer("Redis is unavailable right now. Please try again later.", show_alert=True)
+        return
+
+    if not draft:
+        await query.answer("This draft has expired. Please run /post again.", show_alert=True)
+        await query.edit_message_reply_markup(None)
+        return
+
+    if not can_act_on_draft(draft, query.from_user):
+        await query.answer("You are not allowed to perform this action.", show_alert=True)
+        return
+
+    # Handle "Yes, add notes"
+    if action == "notes_yes":
         await query.answer()
         await query.edit_message_reply_markup(None)
         
@@ -395,56 +3322,62 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data['awaiting_notes_for'] = {
             'original_preview_message_id': query.message.message_id,
             'prompt_message_id': prompt_msg.message_id,
-            'device_codename': device_codename,
-            'poster_username': poster_username,
+            'draft_id': draft_id,
             'user_id': user_id
         }
         return
 
     # Handle "No, continue"
-    if query.data.startswith("notes_no:"):
-        try:
-            _, device_codename, poster_username, expected_user_id = query.data.split(":", 3)
-        except ValueError:
-            await query.edit_message_text("Error: Invalid callback data format.")
-            return
+    if action == "notes_no":
+        await query.answer()
+        keyboard = await review_keyboard(context.bot_data["history"], draft)
+        await query.edit_message_reply_markup(keyboard)
+        return
 
-        if str(user_id) != expected_user_id:
-            await query.answer("You are not allowed to perform this action.", show_alert=True)
-            return
+    # Handle "Schedule": pick a preset delay or type a time
+    if action == "schedule":
+        await query.answer()
+        await query.edit_message_reply_markup(schedule_keyboard(draft_id))
+        return
 
+    if action == "schedule_in":
         await query.answer()
-        keyboard = confirm_keyboard(device_codename, poster_username, user_id)
-        await query.edit_message_reply_markup(keyboard)
+        if await schedule_draft(context, draft, time.time() + delay_minutes * 60, query.message.chat_id):
+            await query.edit_message_reply_markup(None)
+        return
+
+    if action == "schedule_custom":
+        await query.answer()
+        prompt_msg = await query.message.reply_text(
+            f"Reply to this message with the time to post ({SCHEDULE_TZ}):\n"
+            "• in a while: +90m, +2h, +1d\n"
+            "• today or tomorrow: 18:30\n"
+            "• a date: 2025-01-31 18:30",
+            reply_markup=ForceReply(selective=True)
+        )
+        context.user_data['awaiting_schedule_for'] = {
+            'original_preview_message_id': query.message.message_id,
+            'prompt_message_id': prompt_msg.message_id,
+            'draft_id': draft_id,
+            'user_id': user_id
+        }
         return
 
     # Handle "Cancel"
-    if query.data.startswith("cancel_post:"):
-        _, expected_user_id = query.data.split(":")
-        if str(user_id) != expected_user_id:
-            await query.answer("You are not allowed to cancel this post.", show_alert=True)
-            return
+    if action == "cancel_post":
         await query.edit_message_reply_markup(None)
         await query.message.reply_text("❌ Post canceled.")
-        if 'awaiting_notes_for' in context.user_data:
-            del context.user_data['awaiting_notes_for']
+        context.user_data.pop('awaiting_notes_for', None)
+        context.user_data.pop('awaiting_schedule_for', None)
+        try:
+            await delete_draft(redis_client, draft_id)
+        except RedisUnavailableError:
+            pass
         return
 
     # Handle "Confirm Send"
-    if query.data.startswith("confirm_send:"):
-        try:
-            _, device_codename, poster_username, expected_user_id = query.data.split(":", 3)
-        except ValueError:
-            await query.edit_message_text("Error: Invalid callback data format.")
-            return
-
-        if str(user_id) != expected_user_id:
-            await query.answer("You are not allowed to send this post.", show_alert=True)
-            return
-            
-        # Use the helper to run the sync command
-        banner_file_id = await run_redis_command(redis_client, "get", "banner_file_id")
-        
+    if action == "confirm_send":
+        banner_file_id = context.bot_data["banner_cache"].for_record(draft["data"])
         if not banner_file_id:
             await query.message.reply_text(
                 "Failed to send: `BANNER_FILE_ID` is not set. Please /setbanner.",
@@ -452,38 +3385,361 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
 
-        data = fetch_rom_data(device_codename)
-        if not data:
-            await query.edit_message_text("Failed to re-fetch JSON data.")
+        # Consume the draft before anything is published, so a double tap or
+        # a stream entry retried after a later failure cannot post twice
+        try:
+            draft = await claim_draft(redis_client, draft_id)
+        except RedisUnavailableError:
+            await query.answer("Redis is unavailable right now. Please try again later.", show_alert=True)
+            return
+        if not draft:
+            await query.answer("This draft was already posted.", show_alert=True)
             return
 
-        original_caption = query.message.caption_html
-        notes_list_final = []
-        if "<b>Notes:</b>" in original_caption:
+        posts = render_post_targets(draft["data"], draft["poster_username"], draft["notes"])
+        kb = build_keyboard(draft["data"])
+
+        sent, errors = await send_post(context.bot, banner_file_id, posts, kb)
+        await record_post(context.bot_data["history"], draft, banner_file_id, sent)
+        if not sent:
+            # Nothing went out, so the draft comes back for another try
             try:
-                notes_section = original_caption.split("<b>Notes:</b>\n")[1].split("\n\n")[0]
-                notes_list_final = [line.lstrip('- ') for line in notes_section.split("\n") if line.strip()]
-            except IndexError:
+                await save_draft(redis_client, draft)
+            except RedisUnavailableError:
                 pass
+            await query.message.reply_text(
+                "Failed to send to channel: " + "; ".join(f"{target}: {e}" for target, e in errors.items())
+            )
+            return
+        await query.edit_message_reply_markup(None)
+        await query.message.reply_text(f"✅ Post sent to {', '.join(map(str, sent))} successfully.")
+        if errors:
+            await query.message.reply_text(
+                "⚠️ Failed to send to " + "; ".join(f"{target}: {e}" for target, e in errors.items())
+            )
+        return
 
-        msg = format_post(data, poster_username, notes_list_final)
-        kb = build_keyboard(data)
-        bot = Bot(token=BOT_TOKEN)
-
+    # Handle "Update last post": edit the recorded messages in place
+    if action == "edit_post":
+        history: PostHistory = context.bot_data["history"]
         try:
-            await bot.send_photo(
-                chat_id=CHANNEL_ID,
-                photo=banner_file_id, 
-                caption=msg,
-                parse_mode=ParseMode.HTML,
-                reply_markup=kb
+            entry = await history.latest_for(draft["data"]["device_codename"])
+        except RedisUnavailableError:
+            await query.answer("Redis is unavailable right now. Please try again later.", show_alert=True)
+            return
+        if not entry or not can_edit_in_place(entry, draft["data"]):
+            await query.answer("This release has not been posted yet. Please post it instead.", show_alert=True)
+            await query.edit_message_reply_markup(confirm_keyboard(draft_id))
+            return
+
+        await query.answer()
+        edited, unchanged, errors = await edit_published_post(
+            context.bot, entry, draft["data"], draft["poster_username"], draft["notes"]
+        )
+        if not edited and unchanged and not errors:
+            await query.message.reply_text("ℹ️ No changes: the post already shows this build.")
+            return
+        if not edited:
+            await query.message.reply_text(
+                "Failed to update the post: " + "; ".join(f"{target}: {e}" for target, e in errors.items())
             )
-            await query.edit_message_reply_markup(None)
-            await query.message.reply_text(f"✅ Post sent to {CHANNEL_ID} successfully.")
+            return
+        await query.edit_message_reply_markup(None)
+        await query.message.reply_text(f"✏️ Post updated in {', '.join(edited)}.")
+        if errors:
+            await query.message.reply_text(
+                "⚠️ Failed to update in " + "; ".join(f"{target}: {e}" for target, e in errors.items())
+            )
+
+        entry.update(
+            data={k: v for k, v in draft["data"].items() if k != "stale_since"},
+            poster_username=draft["poster_username"],
+            notes=draft["notes"],
+            edited_at=time.time()
+        )
+        try:
+            await history.save(entry)
+            await delete_draft(redis_client, draft_id)
+        except RedisUnavailableError:
+            pass
+
+# === UPDATE SOURCES ===
+def build_handlers():
+    handlers = [
+        CommandHandler("post", post_command),
+        CommandHandler("postall", post_all_command),
+        CommandHandler("devices", devices_command),
+        CommandHandler("scheduled", scheduled_command),
+        CommandHandler("history", history_command),
+        CommandHandler("latest", latest_command),
+        CommandHandler("stats", stats_command),
+        CommandHandler("config", config_command),
+        CommandHandler("banner", view_banner_command),
+        CommandHandler("setbanner", set_banner_command),
+        CommandHandler("removebanner", remove_banner_command),
+        CallbackQueryHandler(callback_handler),
+        InlineQueryHandler(inline_query_handler),
+        MessageHandler(filters.REPLY & filters.TEXT & ~filters.COMMAND, handle_notes_reply),
+    ]
+    for handler in handlers:
+        handler.callback = instrument_handler(handler.callback)
+    return handlers
+
+def allowed_updates_for(handlers):
+    """Update types the given handlers consume, so Telegram skips the rest."""
+    types = set()
+    for handler in handlers:
+        if isinstance(handler, CallbackQueryHandler):
+            types.add(Update.CALLBACK_QUERY)
+        elif isinstance(handler, InlineQueryHandler):
+            types.add(Update.INLINE_QUERY)
+        elif isinstance(handler, (CommandHandler, MessageHandler)):
+            types.add(Update.MESSAGE)
+        else:
+            return Update.ALL_TYPES
+    return sorted(types)
+
+async def start_webhook_server(app, redis_client, allowed_updates):
+    """
+    Serves Telegram's webhook and a /healthz endpoint on an embedded aiohttp
+    server. Updates are verified against the secret token and handed to the
+    application's update queue without waiting for them to be processed.
+    """
+    from aiohttp import web
+
+    async def receive_update(request):
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        # Compared as bytes: compare_digest raises on non-ASCII str input
+        if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json(), app.bot)
         except Exception as e:
-            await query.message.reply_text(f"Failed to send to channel: {e}")
+            print(f"[WARNING] Rejected malformed webhook payload: {e}")
+            return web.Response(status=400)
+        if BOT_ROLE == "ingress":
+            # Enqueue before answering, so a Redis outage makes Telegram redeliver
+            try:
+                await enqueue_update(redis_client, update)
+            except RedisUnavailableError as e:
+                print(f"[WARNING] Could not enqueue update {update.update_id}: {e}")
+                return web.Response(status=503)
+            return web.Response()
+        await app.update_queue.put(update)
+        return web.Response()
+
+    async def health(request):
+        try:
+            redis_ok = bool(await asyncio.wait_for(redis_client.ping(), 2))
+        except Exception:
+            redis_ok = False
+        healthy = app.running and redis_ok
+        return web.json_response(
+            {"status": "ok" if healthy else "degraded", "redis": redis_ok, "pending_updates": app.update_queue.qsize()},
+            status=200 if healthy else 503
+        )
+
+    web_app = web.Application()
+    web_app.router.add_post(WEBHOOK_PATH, receive_update)
+    web_app.router.add_get("/healthz", health)
+    runner = web.AppRunner(web_app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+
+    await app.bot.set_webhook(
+        url=f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=allowed_updates,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+    )
+    print(f"Webhook server listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    return runner
+
+# === UPDATE FAN-OUT (REDIS STREAMS) ===
+# BOT_ROLE=ingress receives updates (polling or webhook) and only appends
+# them to one of STREAM_SHARDS streams, sharded by chat (or user) id.
+# BOT_ROLE=worker processes run the handlers; worker i owns every shard
+# where shard % WORKER_COUNT == i and reads it through a consumer group,
+# so updates of one conversation are always handled in order by one worker.
+def stream_key(shard):
+    return f"updates:{shard}"
+
+def shard_for(update):
+    if update.effective_chat:
+        ident = update.effective_chat.id
+    elif update.effective_user:
+        ident = update.effective_user.id
+    else:
+        ident = update.update_id
+    return ident % STREAM_SHARDS
+
+# Failures of the handlers run for the stream entry being handled; PTB hands
+# handler exceptions to the error handlers instead of raising them
+UPDATE_ERRORS = contextvars.ContextVar("update_errors", default=None)
+
+async def enqueue_update(redis_client, update):
+    await run_redis_command(
+        redis_client, "xadd", stream_key(shard_for(update)),
+        {"update": json.dumps(update.to_dict())},
+        maxlen=STREAM_MAXLEN, approximate=True
+    )
+
+async def publish_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Polling already confirmed this update to Telegram, so it (and the
+    # updates queued behind it) is held until Redis takes it
+    delay = 1
+    while True:
+        try:
+            await enqueue_update(context.bot_data["redis"], update)
+            return
+        except RedisUnavailableError as e:
+            print(f"[WARNING] Could not enqueue update {update.update_id}, retrying in {delay}s: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+
+async def record_update_error(update, context: ContextTypes.DEFAULT_TYPE):
+    """Error handler for workers: marks the stream entry being handled as failed."""
+    errors = UPDATE_ERRORS.get()
+    if errors is not None:
+        errors.append(context.error)
+    else:
+        print(f"[ERROR] Unhandled error: {context.error}")
+
+async def handle_stream_entry(app, fields):
+    """Runs the handlers for one stream entry; raises if any of them failed."""
+    update = Update.de_json(json.loads(fields["update"]), app.bot)
+    errors = []
+    token = UPDATE_ERRORS.set(errors)
+    try:
+        await app.process_update(update)
+    finally:
+        UPDATE_ERRORS.reset(token)
+    if errors:
+        raise errors[0]
+
+async def ensure_consumer_group(redis_client, stream):
+    try:
+        await redis_client.xgroup_create(stream, STREAM_GROUP, id="0", mkstream=True)
+    except RedisError as e:
+        # BUSYGROUP: the group already exists
+        if "BUSYGROUP" not in str(e):
+            raise RedisUnavailableError(f"Failed to create consumer group on {stream}: {e}") from e
+
+async def consume_shard(app, redis_client, shard, consumer, stopping):
+    """
+    Handles one shard's stream in order. Entries are acknowledged after the
+    handlers succeeded; a failed entry stays pending and is retried before
+    newer ones, and after STREAM_MAX_DELIVERIES attempts it is moved to
+    updates:dead. Entries left pending by a crashed worker are claimed
+    after STREAM_CLAIM_IDLE_MS.
+
+    A shard is the unit of ordering, so its entries run one at a time and
+    bypass the OrderedUpdateProcessor; a worker handles its shards in
+    parallel, and STREAM_SHARDS sets how many chats share one queue.
+
+    Once `stopping` is set the loop finishes the entry in hand and returns;
+    entries read but not handled stay pending and are re-read on restart.
+    """
+    stream = stream_key(shard)
+    await ensure_consumer_group(redis_client, stream)
+    # "0" re-reads this consumer's own pending entries, ">" reads new ones
+    last_id = "0"
+    attempts = {}
+    last_claim = 0.0
+
+    while not stopping.is_set():
+        try:
+            if time.monotonic() - last_claim > STREAM_CLAIM_IDLE_MS / 1000:
+                last_claim = time.monotonic()
+                _, claimed, *_ = await run_redis_command(
+                    redis_client, "xautoclaim", stream, STREAM_GROUP, consumer,
+                    STREAM_CLAIM_IDLE_MS, start_id="0-0", count=STREAM_BATCH
+                )
+                if claimed:
+                    last_id = "0"
+
+            response = await run_redis_command(
+                redis_client, "xreadgroup", STREAM_GROUP, consumer, {stream: last_id},
+                count=STREAM_BATCH, block=None if last_id == "0" else STREAM_BLOCK_MS
+            )
+        except RedisUnavailableError:
+            await asyncio.sleep(1)
+            continue
+
+        entries = response[0][1] if response else []
+        if last_id == "0" and not entries:
+            last_id = ">"
+            continue
+
+        for entry_id, fields in entries:
+            if stopping.is_set():
+                return
+            try:
+                await handle_stream_entry(app, fields)
+            except Exception as e:
+                attempts[entry_id] = attempts.get(entry_id, 0) + 1
+                print(f"[ERROR] Update {entry_id} on {stream} failed (attempt {attempts[entry_id]}): {e}")
+                if attempts[entry_id] < STREAM_MAX_DELIVERIES:
+                    # Keep order: retry this entry before anything newer
+                    last_id = "0"
+                    await asyncio.sleep(min(2 ** attempts[entry_id], 30))
+                    break
+                try:
+                    await run_redis_command(
+                        redis_client, "xadd", "updates:dead", fields, maxlen=STREAM_MAXLEN, approximate=True
+                    )
+                except RedisUnavailableError:
+                    pass
+            attempts.pop(entry_id, None)
+            try:
+                await run_redis_command(redis_client, "xack", stream, STREAM_GROUP, entry_id)
+            except RedisUnavailableError:
+                pass
 
 # main() function
+
+def register_gauges(app):
+    dispatcher = app.bot.rate_limiter
+    if isinstance(dispatcher, SendDispatcher):
+        METRICS.gauge("telegram_queue_depth", lambda: {
+            (("priority", "interactive"),): dispatcher.stats()["queued_interactive"],
+            (("priority", "bulk"),): dispatcher.stats()["queued_bulk"],
+        })
+        METRICS.gauge("telegram_in_flight", lambda: dispatcher.stats()["in_flight"])
+    METRICS.gauge("update_queue_depth", app.update_queue.qsize)
+    if isinstance(app.update_processor, OrderedUpdateProcessor):
+        METRICS.gauge("updates_in_flight", lambda: app.update_processor.in_flight)
+    if "ota_cache" in app.bot_data:
+        ota_cache = app.bot_data["ota_cache"]
+        METRICS.gauge("ota_cache_entries", lambda: len(ota_cache))
+        METRICS.gauge("ota_circuit_open", lambda: int(ota_cache.breaker.state != "closed"))
+        METRICS.gauge("devices_indexed", lambda: len(app.bot_data["device_index"]))
+
+async def setup_bot_data(app, redis_client, http_client):
+    app.bot_data["redis"] = redis_client
+    app.bot_data["settings"] = SettingsStore(redis_client)
+    app.bot_data["http"] = http_client
+    app.bot_data["ota_cache"] = OtaCache(http_client, redis_client)
+    app.bot_data["device_index"] = DeviceIndex()
+    app.bot_data["banner_cache"] = BannerCache(redis_client)
+    app.bot_data["history"] = PostHistory(redis_client)
+    app.bot_data["scheduler"] = PostScheduler(redis_client, app.bot_data["history"])
+    app.bot_data["preview_cache"] = PreviewCache(app.bot_data["banner_cache"])
+    app.bot_data["ota_cache"].listeners.append(app.bot_data["preview_cache"].on_record)
+    app.bot_data["banner_cache"].listeners.append(app.bot_data["preview_cache"].on_banners)
+    try:
+        loaded = await app.bot_data["settings"].load()
+        print(f"Settings overrides loaded from Redis: {loaded}.")
+        loaded = await app.bot_data["device_index"].load(redis_client)
+        print(f"Device index loaded from Redis: {loaded} devices.")
+        loaded = await app.bot_data["banner_cache"].load()
+        print(f"Banners loaded from Redis: {loaded}.")
+        # Fill the inline previews from the shared cache tier, no HTTP needed
+        await app.bot_data["ota_cache"].warm(app.bot_data["device_index"].codenames())
+        print(f"Inline previews ready for {len(app.bot_data['preview_cache'])} devices.")
+    except RedisUnavailableError:
+        pass
+
 async def main():
     if not BOT_TOKEN:
         print("[ERROR] BOT_TOKEN not found. Set it in Secrets or private.env")
@@ -493,46 +3749,145 @@ async def main():
         print("[ERROR] REDIS_URL not found. Set it in Secrets or private.env")
         return
 
-    # Initialize standard (sync) Redis connection
+    if BOT_MODE not in ("polling", "webhook"):
+        print(f"[ERROR] Unknown BOT_MODE '{BOT_MODE}'. Use 'polling' or 'webhook'.")
+        return
+
+    if BOT_ROLE not in ("all", "ingress", "worker"):
+        print(f"[ERROR] Unknown BOT_ROLE '{BOT_ROLE}'. Use 'all', 'ingress' or 'worker'.")
+        return
+
+    if BOT_ROLE == "worker" and not 0 <= WORKER_INDEX < WORKER_COUNT:
+        print(f"[ERROR] WORKER_INDEX must be between 0 and WORKER_COUNT - 1 ({WORKER_COUNT - 1}), got {WORKER_INDEX}.")
+        return
+
+    if BOT_MODE == "webhook" and BOT_ROLE != "worker" and not WEBHOOK_URL:
+        print("[ERROR] BOT_MODE=webhook requires WEBHOOK_URL (the public https base URL).")
+        return
+
+    # Initialize asyncio Redis connection pool
     redis_client = None
     try:
-        print(f"Attempting to connect to Redis (sync)...")
-        redis_client = redis.from_url(REDIS_URL, decode_responses=True)
-        redis_client.ping()
-        print("Successfully connected to Redis (sync).")
+        print(f"Attempting to connect to Redis (pool of {REDIS_MAX_CONNECTIONS})...")
+        pool = redis.BlockingConnectionPool.from_url(
+            REDIS_URL,
+            decode_responses=True,
+            max_connections=REDIS_MAX_CONNECTIONS,
+            timeout=REDIS_POOL_TIMEOUT,
+        )
+        redis_client = redis.Redis.from_pool(pool)
+        await redis_client.ping()
+        print("Successfully connected to Redis.")
     except Exception as e:
         print(f"[ERROR] Failed to connect to Redis: {e}")
         print("Please ensure Redis server is running and REDIS_URL is correct.")
         return
 
+    # Shared HTTP pool for the OTA source
+    http_client = PooledHttpClient()
+    print(f"HTTP client ready (HTTP/2: {HTTP2_AVAILABLE}, {HTTP_MAX_PER_HOST} connections per host).")
+
+    handlers = build_handlers()
+    allowed_updates = allowed_updates_for(handlers)
+
     # Build and start bot
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
-    app.bot_data["redis"] = redis_client
-    
-    # ... (Handlers are added just as before) ...
-    app.add_handler(CommandHandler("post", post_command))
-    app.add_handler(CommandHandler("banner", view_banner_command))
-    app.add_handler(CommandHandler("setbanner", set_banner_command))
-    app.add_handler(CommandHandler("removebanner", remove_banner_command))
-    app.add_handler(CallbackQueryHandler(callback_handler))
-    app.add_handler(MessageHandler(filters.REPLY & filters.TEXT & ~filters.COMMAND, handle_notes_reply))
-
-    print("Bot is running...")
+    if BOT_ROLE == "ingress":
+        # Only enqueues updates, in arrival order, for the workers
+        app = ApplicationBuilder().token(BOT_TOKEN).rate_limiter(SendDispatcher()).build()
+        app.add_handler(TypeHandler(Update, publish_update))
+    else:
+        app = (
+            ApplicationBuilder()
+            .token(BOT_TOKEN)
+            .rate_limiter(SendDispatcher())
+            .concurrent_updates(OrderedUpdateProcessor(MAX_CONCURRENT_UPDATES))
+            .persistence(RedisPersistence(redis_client))
+            .context_types(ContextTypes(bot_data=BotData))
+            .build()
+        )
+        for handler in handlers:
+            app.add_handler(handler)
+        if BOT_ROLE == "worker":
+            app.add_error_handler(record_update_error)
+
+        if DEVICE_INDEX_REFRESH_INTERVAL > 0:
+            app.job_queue.run_repeating(device_index_job, interval=DEVICE_INDEX_REFRESH_INTERVAL, first=0, name="device_index")
+
+        if OTA_WATCH_INTERVAL > 0:
+            app.job_queue.run_repeating(ota_watch_job, interval=OTA_WATCH_INTERVAL, first=10, name="ota_watch")
+            print(f"OTA watcher scheduled every {OTA_WATCH_INTERVAL}s.")
+
+    # initialize() loads bot_data from persistence, so process-local objects go in afterwards
     await app.initialize()
+    background = []
+    if BOT_ROLE == "ingress":
+        app.bot_data["redis"] = redis_client
+    else:
+        await setup_bot_data(app, redis_client, http_client)
+        background.append(asyncio.create_task(app.bot_data["settings"].listen()))
+        background.append(asyncio.create_task(app.bot_data["banner_cache"].listen()))
+        if hasattr(signal, "SIGHUP"):
+            settings_store = app.bot_data["settings"]
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGHUP, lambda: app.create_task(settings_store.reload(reread_env=True))
+            )
+        background.append(asyncio.create_task(app.bot_data["scheduler"].listen()))
+        background.append(asyncio.create_task(app.bot_data["scheduler"].run(app.bot)))
+    register_gauges(app)
+
+    print(f"Bot is running (role: {BOT_ROLE}, mode: {BOT_MODE})...")
     await app.start()
-    await app.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+    webhook_runner = None
+    metrics_runner = await start_metrics_server() if METRICS_PORT else None
+    stream_client = None
+    consumers = []
+    stopping = asyncio.Event()
+    if BOT_ROLE == "worker":
+        shards = [s for s in range(STREAM_SHARDS) if s % WORKER_COUNT == WORKER_INDEX]
+        consumer = f"worker-{WORKER_INDEX}"
+        # Blocking stream reads get their own connections so handlers never wait on them
+        stream_client = redis.Redis.from_pool(redis.BlockingConnectionPool.from_url(
+            REDIS_URL, decode_responses=True, max_connections=len(shards) + 1
+        ))
+        consumers = [asyncio.create_task(consume_shard(app, stream_client, s, consumer, stopping)) for s in shards]
+        print(f"Worker {WORKER_INDEX}/{WORKER_COUNT} consuming shards {shards}.")
+    elif BOT_MODE == "webhook":
+        webhook_runner = await start_webhook_server(app, redis_client, allowed_updates)
+    else:
+        await app.updater.start_polling(allowed_updates=allowed_updates)
     
     try:
         await asyncio.Event().wait()
     except (KeyboardInterrupt, SystemExit):
         print("Bot stopping by user request...")
     finally:
-        print("Shutting down... Closing Redis connection.")
-        if redis_client:
-            redis_client.close()
-        await app.updater.stop()
+        print("Shutting down...")
+        if consumers:
+            # Let every consumer finish the update it is handling, so a send
+            # is never cut off halfway and then repeated after the restart
+            stopping.set()
+            _, pending = await asyncio.wait(consumers, timeout=SHUTDOWN_DRAIN_TIMEOUT + STREAM_BLOCK_MS / 1000)
+            if pending:
+                print(f"[WARNING] {len(pending)} stream consumers did not finish in time; their updates stay pending.")
+            background += consumers
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        if stream_client:
+            await stream_client.aclose()
+        if webhook_runner:
+            await webhook_runner.cleanup()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        if app.updater.running:
+            await app.updater.stop()
         await app.stop()
         await app.shutdown()
+        # Closed last so in-flight handlers can still use them
+        print("Closing Redis and HTTP connections.")
+        if redis_client:
+            await redis_client.aclose()
+        await http_client.aclose()
         print("Bot has shutdown.")
 
 if __name__ == "__main__":